@@ -0,0 +1,61 @@
+"""Заполнение email_normalized/username_normalized существующих пользователей.
+
+    python backfill_identity.py [--batch-size 1000]
+
+Шаг 2 scripts/normalize_identity.sql. Значения считает crud.normalize_identity -
+та же функция, что и при записи и входе: SQL lower(trim(...)) с ней не совпадает
+(trim убирает только пробелы, lower() в локали C не меняет кириллицу).
+Обрабатываются только строки с NULL, поэтому запуск можно повторять - в том числе
+после выкладки кода, чтобы дозаполнить строки, записанные старой версией.
+"""
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.engine import Engine
+import argparse
+
+from crud import normalize_identity
+from database import SessionLocal, user_data_engines
+from models import User
+
+def backfill_engine(engine: Engine, batch_size: int) -> int:
+    """Заполняет колонки пачками по id; каждая пачка - отдельная короткая транзакция"""
+    filled = 0
+    last_id = 0
+    db = SessionLocal(bind=engine)
+    try:
+        while True:
+            rows = db.execute(
+                select(User.id, User.email, User.username)
+                .where(User.id > last_id, or_(User.email_normalized.is_(None), User.username_normalized.is_(None)))
+                .order_by(User.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            db.connection().execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == bindparam("user_id"))
+                .values(email_normalized=bindparam("email_value"), username_normalized=bindparam("username_value")),
+                [
+                    {
+                        "user_id": row.id,
+                        "email_value": normalize_identity(row.email),
+                        "username_value": normalize_identity(row.username),
+                    }
+                    for row in rows
+                ]
+            )
+            db.commit()
+            filled += len(rows)
+    finally:
+        db.close()
+    return filled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заполнение нормализованных email/username")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    for name, engine in user_data_engines().items():
+        print(f"{name}: заполнено {backfill_engine(engine, args.batch_size)} пользователей")
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный бенчмарк эндпоинтов аутентификации и профиля.
+
+Режимы:
+  - in-process (по умолчанию): приложение поднимается внутри процесса через
+    httpx.ASGITransport на SQLite во временном каталоге (или --database-url);
+  - --base-url http://localhost:8000: нагрузка на запущенный uvicorn.
+
+Сидирует --users пользователей, затем для каждого уровня --concurrency
+виртуальные пользователи (по одному клиенту с cookie на каждого) гоняют
+смесь запросов --mix в течение --duration секунд.
+
+Результат - JSON с пропускной способностью и p50/p95/p99 по маршрутам.
+С --baseline сравнивает p95 с прошлым прогоном и возвращает код 1 при
+регрессии больше --tolerance.
+
+Требует httpx.
+
+Запуск:
+  python -m benchmarks.load --users 50 --concurrency 1,8,32 --duration 10 --output bench.json
+  python -m benchmarks.load --baseline bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_MIX = "login=10,refresh=10,profile_me=40,search=30,avatar=10"
+PASSWORD = "bench-password-123"
+AVATAR_BYTES = b"\x89PNG\r\n\x1a\n" + os.urandom(16 * 1024)
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, username: str):
+        self.client = client
+        self.username = username
+        self.headers: Dict[str, str] = {}
+
+    def _remember(self, response: httpx.Response) -> httpx.Response:
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        return response
+
+    async def login(self):
+        return self._remember(await self.client.post(
+            "/auth/login", json={"username": self.username, "password": PASSWORD}
+        ))
+
+    async def refresh(self):
+        return self._remember(await self.client.post("/auth/refresh"))
+
+    async def profile_me(self):
+        return await self.client.get("/profile/me", headers=self.headers)
+
+    async def search(self):
+        return await self.client.get("/profile/", params={"q": "bench", "limit": 20}, headers=self.headers)
+
+    async def avatar(self):
+        files = {"file": ("avatar.png", AVATAR_BYTES, "image/png")}
+        return await self.client.post("/profile/me/avatar", files=files, headers=self.headers)
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        route, _, weight = item.partition("=")
+        if not hasattr(VirtualUser, route.strip()):
+            raise SystemExit(f"Неизвестный маршрут в --mix: {route}")
+        weights[route.strip()] = int(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return round(sorted_values[index], 2)
+
+
+async def run_level(make_client, usernames: List[str], concurrency: int, duration: float,
+                    weights: Dict[str, int], seed: int) -> dict:
+    samples: Dict[str, List[float]] = {route: [] for route in weights}
+    errors: Dict[str, int] = {route: 0 for route in weights}
+    routes, route_weights = list(weights), list(weights.values())
+
+    async def worker(index: int):
+        rng = random.Random(seed + index)
+        async with make_client() as client:
+            vu = VirtualUser(client, usernames[index % len(usernames)])
+            await vu.login()
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                route = rng.choices(routes, route_weights)[0]
+                started = time.perf_counter()
+                try:
+                    response = await getattr(vu, route)()
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                samples[route].append((time.perf_counter() - started) * 1000)
+                if not ok:
+                    errors[route] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    report = {"concurrency": concurrency, "duration_s": round(elapsed, 2), "routes": {}}
+    total = 0
+    for route, latencies in samples.items():
+        latencies.sort()
+        total += len(latencies)
+        report["routes"][route] = {
+            "count": len(latencies),
+            "errors": errors[route],
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        }
+    report["total_requests"] = total
+    report["throughput_rps"] = round(total / elapsed, 2)
+    return report
+
+
+async def seed_remote(make_client, usernames: List[str]) -> None:
+    async with make_client() as client:
+        for username in usernames:
+            response = await client.post("/users/", json={
+                "email": f"{username}@bench.local", "username": username, "password": PASSWORD,
+                "first_name": "Bench", "last_name": username,
+            })
+            if response.status_code not in (201, 400):
+                raise SystemExit(f"Не удалось создать {username}: {response.status_code} {response.text}")
+
+
+def seed_in_process(usernames: List[str]) -> None:
+    from database import SessionLocal, get_engine
+    from crud import insert_user, identity_values
+    from security import get_password_hash
+
+    hashed_password = get_password_hash(PASSWORD)  # bcrypt один раз на всех
+    db = SessionLocal(bind=get_engine())
+    try:
+        for username in usernames:
+            insert_user(db, {
+                **identity_values(email=f"{username}@bench.local", username=username),
+                "hashed_password": hashed_password, "first_name": "Bench", "last_name": username,
+                "profile_visibility": "public", "show_email": False, "show_phone": False,
+                "show_birth_date": False, "profile_completeness": 2,
+            })
+        db.commit()
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def in_process_app(database_url: str):
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("SECRET_KEY", "bench-secret")
+    os.environ.setdefault("STATS_REFRESH_SECONDS", "0")
+    from main import create_app
+
+    app = create_app(create_schema=True)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        yield lambda: httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[dict]:
+    """p95 маршрутов, ухудшившиеся больше чем на tolerance относительно baseline"""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in report["levels"]:
+        base_level = baseline_levels.get(level["concurrency"])
+        if not base_level:
+            continue
+        for route, stats in level["routes"].items():
+            base = base_level["routes"].get(route, {}).get("p95_ms")
+            if base and stats["p95_ms"] and stats["p95_ms"] > base * (1 + tolerance):
+                regressions.append({
+                    "concurrency": level["concurrency"], "route": route,
+                    "baseline_p95_ms": base, "p95_ms": stats["p95_ms"],
+                })
+    return regressions
+
+
+async def run(args) -> dict:
+    weights = parse_mix(args.mix)
+    usernames = [f"bench{i:05d}" for i in range(args.users)]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    if args.base_url:
+        def make_client():
+            return httpx.AsyncClient(base_url=args.base_url, timeout=30)
+        await seed_remote(make_client, usernames)
+        reports = [await run_level(make_client, usernames, c, args.duration, weights, args.seed) for c in levels]
+        mode = args.base_url
+    else:
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            # Аватары пишутся в uploads/ относительно текущего каталога - не мусорим в репозитории
+            os.chdir(tmp)
+            try:
+                database_url = args.database_url or f"sqlite:///{tmp}/bench.db"
+                async with in_process_app(database_url) as make_client:
+                    seed_in_process(usernames)
+                    reports = [await run_level(make_client, usernames, c, args.duration, weights, args.seed) for c in levels]
+            finally:
+                os.chdir(cwd)
+        mode = "in-process"
+
+    return {
+        "mode": mode,
+        "users": args.users,
+        "mix": weights,
+        "duration_per_level_s": args.duration,
+        "levels": reports,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="Адрес запущенного сервера; без него - in-process")
+    parser.add_argument("--database-url", help="БД для in-process режима (по умолчанию временная SQLite)")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения p95")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимый рост p95 (0.2 = 20%%)")
+    args = parser.parse_args()
+    # Пути - относительно каталога запуска (in-process режим на время прогона меняет текущий каталог)
+    args.output = args.output and os.path.abspath(args.output)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+
+    # Приложение логирует через print - уводим это в stderr, stdout оставляем под JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк проекции публичных профилей (GET /profile/?q=...).
+
+Сравнивает построчный filter_user_profile (dict -> pydantic -> jsonable_encoder)
+с пакетной скомпилированной проекцией project_user_profiles (dict -> orjson).
+Обе стороны вызываются как в поиске: зритель и его друзья среди строк.
+
+Запуск: python -m benchmarks.profile_projection --rows 20 --iterations 500
+"""
+import argparse
+import json
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from crud import filter_user_profile, project_user_profiles
+from models import User, PUBLIC_PROFILE_COLUMNS
+from benchmarks.serialization import make_users, measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    users = make_users(args.rows)
+    rows = [{column.key: getattr(user, column.key) for column in PUBLIC_PROFILE_COLUMNS} for user in users]
+    # Зритель не входит в выдачу; половина строк - его друзья (follows.friends_among)
+    viewer = User(id=args.rows)
+    friend_ids = frozenset(user.id for user in users if user.id % 2 == 0)
+
+    def per_row(users):
+        return json.dumps(jsonable_encoder([
+            filter_user_profile(user, viewer, friend_ids) for user in users
+        ])).encode("utf-8")
+
+    def batch(rows):
+        return orjson.dumps(project_user_profiles(rows, viewer.id, friend_ids=friend_ids))
+
+    before = measure(per_row, users, args.iterations)
+    after = measure(batch, rows, args.iterations)
+
+    print(json.dumps({
+        "rows": args.rows,
+        "iterations": args.iterations,
+        "per_row_us_per_request": round(before, 1),
+        "batch_us_per_request": round(after, 1),
+        "speedup": round(before / after, 1) if after else None,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сериализации списка пользователей (GET /users/).
+
+Сравнивает стандартный путь FastAPI (ORM-объект -> pydantic -> jsonable_encoder -> json)
+с быстрым путем (строка select -> dict -> orjson).
+
+Запуск: python -m benchmarks.serialization --rows 100 --iterations 200
+"""
+import argparse
+import json
+import time
+from datetime import datetime, date
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from models import User, USER_RESPONSE_COLUMNS
+from schemas import UserResponse
+
+
+def make_users(count: int) -> list:
+    now = datetime.utcnow()
+    return [
+        User(
+            id=i,
+            email=f"user{i}@example.com",
+            username=f"user{i}",
+            hashed_password="x",
+            is_active=True,
+            created_at=now,
+            first_name="Иван",
+            last_name="Петров",
+            phone="+70000000000",
+            birth_date=date(1990, 1, 1),
+            bio="Lorem ipsum dolor sit amet " * 8,
+            avatar_url=f"/uploads/avatars/{i}.png",
+            location="Алматы",
+            website="https://example.com",
+            company="ACME",
+            job_title="Engineer",
+            profile_visibility="public",
+            show_email=False,
+            show_phone=False,
+            show_birth_date=False,
+            last_login=now,
+            profile_updated_at=now,
+        )
+        for i in range(count)
+    ]
+
+
+def default_path(users: list) -> bytes:
+    validate = getattr(UserResponse, "model_validate", None) or UserResponse.from_orm
+    models = [validate(user) for user in users]
+    return json.dumps(jsonable_encoder(models)).encode("utf-8")
+
+
+def fast_path(rows: list) -> bytes:
+    return orjson.dumps(rows)
+
+
+def measure(func, payload, iterations: int) -> float:
+    """Среднее время одного вызова в микросекундах"""
+    func(payload)  # прогрев
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(payload)
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    users = make_users(args.rows)
+    rows = [{column.name: getattr(user, column.name) for column in USER_RESPONSE_COLUMNS} for user in users]
+
+    before = measure(default_path, users, args.iterations)
+    after = measure(fast_path, rows, args.iterations)
+
+    print(json.dumps({
+        "rows": args.rows,
+        "iterations": args.iterations,
+        "default_us_per_request": round(before, 1),
+        "orjson_us_per_request": round(after, 1),
+        "speedup": round(before / after, 1) if after else None,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
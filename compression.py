@@ -0,0 +1,160 @@
+"""Сжатие ответов (gzip, brotli/zstd если установлены) и предсжатые копии статики"""
+from fastapi.concurrency import run_in_threadpool
+from pathlib import Path
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Callable, Dict, Optional, Tuple
+import gzip
+
+from config import COMPRESSION_MIN_SIZE, COMPRESSION_OFFLOAD_SIZE, COMPRESSION_EXCLUDE_PATHS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Кодировки в порядке предпочтения сервера; недоступные библиотеки просто пропускаются
+ENCODERS: Dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    ENCODERS["br"] = lambda data: brotli.compress(data, quality=4)
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+ENCODERS["gzip"] = lambda data: gzip.compress(data, compresslevel=6)
+
+# Расширения файлов-спутников, которые умеет отдавать nginx (gzip_static / brotli_static)
+SIDECAR_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Первая из ENCODERS, которую клиент принимает (q > 0)"""
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip())
+    for encoding in ENCODERS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def weaken_etag(headers: MutableHeaders) -> None:
+    """Сильный ETag -> W/: сжатое и исходное представления не должны делить сильный валидатор"""
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["etag"] = f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """Сжимает ответы целиком, если тело больше min_size и тип сжимаемый.
+
+    Не трогает: пути из exclude_paths, ответы с Content-Encoding или
+    Cache-Control: no-transform (так маршрут может отказаться от сжатия),
+    потоковые ответы. Тела больше offload_size сжимаются в пуле потоков,
+    чтобы не блокировать event loop.
+    
+    Если клиент принимает сжатие, ETag ответа ослабляется (W/) - для всех ответов,
+    включая 304 и маленькие тела, чтобы валидатор не зависел от размера тела.
+    If-None-Match сравнивается слабо (crud.etag_matches), повторная проверка работает.
+    """
+    
+    def __init__(
+        self,
+        app: ASGIApp,
+        min_size: int = COMPRESSION_MIN_SIZE,
+        offload_size: int = COMPRESSION_OFFLOAD_SIZE,
+        exclude_paths: Tuple[str, ...] = COMPRESSION_EXCLUDE_PATHS
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.offload_size = offload_size
+        self.exclude_paths = exclude_paths
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message: Optional[Message] = None
+        passthrough = False
+        
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            
+            if message["type"] == "http.response.start":
+                weaken_etag(MutableHeaders(scope=message))
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" in headers
+                    or "no-transform" in headers.get("cache-control", "")
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                ):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < self.min_size:
+                # Потоковый или маленький ответ - отдаем как есть
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+            
+            encoder = ENCODERS[encoding]
+            if len(body) >= self.offload_size:
+                compressed = await run_in_threadpool(encoder, body)
+            else:
+                compressed = encoder(body)
+            
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_wrapper)
+
+
+def write_precompressed_sidecars(path: Path, content: bytes, min_saving: float = 0.1) -> None:
+    """Пишет рядом с файлом .gz/.br копии для nginx gzip_static/brotli_static.
+
+    Копия сохраняется, только если она меньше оригинала хотя бы на min_saving -
+    уже сжатые форматы (jpeg, png, webp) обычно не выигрывают и пропускаются.
+    """
+    for encoding, suffix in SIDECAR_SUFFIXES.items():
+        encoder = ENCODERS.get(encoding)
+        if encoder is None:
+            continue
+        compressed = encoder(content)
+        if len(compressed) <= len(content) * (1 - min_saving):
+            path.with_name(path.name + suffix).write_bytes(compressed)
+
+def remove_with_sidecars(path: Path) -> None:
+    """Удаляет файл вместе с предсжатыми копиями"""
+    for candidate in [path] + [path.with_name(path.name + suffix) for suffix in SIDECAR_SUFFIXES.values()]:
+        if candidate.exists():
+            candidate.unlink()
@@ -0,0 +1,344 @@
+from sqlalchemy import select, exists, insert, update, delete
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from typing import AbstractSet, Optional, List, Callable, NamedTuple
+from datetime import datetime
+from operator import itemgetter
+
+from database import SessionLocal, get_engine, shards
+from models import (
+    User, LIVE_USER, UserDirectory, PROFILE_COMPLETENESS_FIELDS, PUBLIC_PROFILE_COLUMNS, USER_RESPONSE_COLUMNS
+)
+from schemas import UserPublicProfile
+
+def query_users(db: Session, *columns):
+    """Query по живым User; если переданы колонки - загружаются только они (load_only)"""
+    query = db.query(User).filter(LIVE_USER)
+    if columns:
+        query = query.options(load_only(*columns))
+    return query
+
+def user_exists(db: Session, *criteria) -> bool:
+    """EXISTS-проверка живого пользователя без загрузки строки"""
+    return db.query(exists().where(LIVE_USER, *criteria)).scalar()
+
+def normalize_identity(value: str) -> str:
+    """Форма email/username для сравнения: Foo@x.com и foo@x.com - один пользователь"""
+    return value.strip().lower()
+
+def identity_values(email: Optional[str] = None, username: Optional[str] = None) -> dict:
+    """Значения email/username вместе с нормализованными колонками - для записи в users"""
+    values = {}
+    if email is not None:
+        values["email"] = email
+        values["email_normalized"] = normalize_identity(email)
+    if username is not None:
+        values["username"] = username
+        values["username_normalized"] = normalize_identity(username)
+    return values
+
+def get_user_by_username(db: Session, username: str, *columns) -> Optional[User]:
+    return query_users(db, *columns).filter(User.username_normalized == normalize_identity(username)).first()
+
+def get_user_by_email(db: Session, email: str, *columns) -> Optional[User]:
+    return query_users(db, *columns).filter(User.email_normalized == normalize_identity(email)).first()
+
+def get_user_by_id(db: Session, user_id: int, *columns) -> Optional[User]:
+    return query_users(db, *columns).filter(User.id == user_id).first()
+
+def select_user_response():
+    """SELECT только колонок UserResponse живых пользователей, без гидрации ORM-объектов"""
+    return select(*USER_RESPONSE_COLUMNS).where(LIVE_USER)
+
+def fetch_user_dicts(db: Session, stmt) -> List[dict]:
+    """Выполняет запрос и возвращает строки как dict, готовые для ORJSONResponse.
+
+    Строки не попадают в identity map сессии и не проходят через pydantic -
+    используется только в read-only эндпоинтах.
+    """
+    return [dict(row) for row in db.execute(stmt).mappings()]
+
+def fetch_user_page(db: Session, stmt, skip: int, limit: int) -> List[dict]:
+    """Страница строк пользователей (в stmt должна быть колонка id).
+
+    При шардировании - scatter-gather: каждый шард отдает первые skip + limit
+    строк по id, страница вырезается после слияния; глубокие страницы обходятся
+    дороже в число шардов раз.
+    """
+    if not shards.enabled:
+        return fetch_user_dicts(db, stmt.offset(skip).limit(limit))
+    rows = fetch_user_dicts(db, stmt.order_by(User.id).limit(skip + limit))
+    # Строки шардов идут отсортированными сериями - sort сливает их за линейное время
+    rows.sort(key=itemgetter("id"))
+    return rows[skip:skip + limit]
+
+def count_completed_fields(values: dict) -> int:
+    """Считает заполненные поля профиля в словаре значений"""
+    return sum(1 for field in PROFILE_COMPLETENESS_FIELDS if values.get(field))
+
+def set_profile_field(user: User, field: str, value) -> None:
+    """Устанавливает поле профиля, инкрементально обновляя profile_completeness"""
+    if field in PROFILE_COMPLETENESS_FIELDS:
+        delta = bool(value) - bool(getattr(user, field))
+        user.profile_completeness = (user.profile_completeness or 0) + delta
+    setattr(user, field, value)
+
+def touch_profile(user: User) -> None:
+    """Отмечает изменение профиля через ORM: время и версия (version + 1 считается в UPDATE)"""
+    user.profile_updated_at = datetime.utcnow()
+    user.version = User.version + 1
+
+def profile_etag(version: int) -> str:
+    return f'"{version}"'
+
+def etag_matches(header: str, version: int) -> bool:
+    """Совпадает ли версия с If-Match/If-None-Match (список ETag через запятую или *)"""
+    etag = profile_etag(version)
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def diff_user_fields(user: User, values: dict) -> dict:
+    """Только поля, значение которых действительно отличается от текущего"""
+    return {
+        field: value for field, value in values.items()
+        if hasattr(user, field) and getattr(user, field) != value
+    }
+
+def update_user_fields(db: Session, user: User, changes: dict) -> Optional[dict]:
+    """Записывает изменения одним UPDATE ... RETURNING с проверкой версии.
+
+    Возвращает колонки UserResponse и новую version; None - профиль уже изменил
+    другой запрос (версия в БД не совпала с загруженной).
+    """
+    values = dict(changes)
+    delta = sum(
+        bool(value) - bool(getattr(user, field))
+        for field, value in changes.items() if field in PROFILE_COMPLETENESS_FIELDS
+    )
+    if delta:
+        values["profile_completeness"] = (user.profile_completeness or 0) + delta
+    values["profile_updated_at"] = datetime.utcnow()
+    values["version"] = User.version + 1
+    
+    stmt = update(User).where(User.id == user.id, User.version == user.version).values(**values)
+    stmt = stmt.execution_options(synchronize_session=False)
+    columns = USER_RESPONSE_COLUMNS + (User.__table__.c.version,)
+    if db.get_bind().dialect.update_returning:
+        row = db.execute(stmt.returning(*columns)).mappings().first()
+    elif db.execute(stmt).rowcount:
+        row = db.execute(select(*columns).where(User.id == user.id)).mappings().first()
+    else:
+        row = None
+    return dict(row) if row else None
+
+def get_dialect_insert(db: Session):
+    """insert() с поддержкой ON CONFLICT для диалекта сессии или None"""
+    return {
+        "postgresql": postgresql.insert,
+        "sqlite": sqlite.insert,
+    }.get(db.get_bind().dialect.name)
+
+def allocate_user_id(values: dict) -> Optional[int]:
+    """Резервирует email/username в каталоге шардов и выдает глобальный id; None - заняты.
+
+    Резерв фиксируется отдельной транзакцией до вставки в шард: у общей БД и шарда
+    нет общего коммита, и порядок фиксации должен быть известен. Если строка users
+    так и не закоммитилась, резерв снимает discard_user_id.
+    """
+    identity = {
+        "email_normalized": values["email_normalized"],
+        "username_normalized": values["username_normalized"],
+        "created_at": datetime.utcnow(),
+    }
+    db = SessionLocal(bind=get_engine())
+    try:
+        dialect_insert = get_dialect_insert(db)
+        if dialect_insert is not None:
+            stmt = dialect_insert(UserDirectory).values(**identity).on_conflict_do_nothing()
+            user_id = db.execute(stmt.returning(UserDirectory.id)).scalar()
+        else:
+            try:
+                user_id = db.execute(insert(UserDirectory).values(**identity).returning(UserDirectory.id)).scalar()
+            except IntegrityError:
+                user_id = None
+        db.commit()
+        return user_id
+    finally:
+        db.close()
+
+def discard_user_id(user_id: int) -> bool:
+    """Удаляет строку каталога, если пользователя с этим id нет на его шарде.
+
+    Вызывается после неудачной вставки или коммита регистрации и из
+    reshard.py --prune-directory. Возвращает True, если резерв снят.
+    """
+    if not shards.enabled:
+        return False
+    with shards.engine(shards.shard_for(user_id)).connect() as conn:
+        if conn.execute(select(User.id).where(User.id == user_id)).first() is not None:
+            return False
+    with get_engine().begin() as conn:
+        conn.execute(delete(UserDirectory).where(UserDirectory.id == user_id))
+    return True
+
+def reserve_identity(db: Session, user_id: int, email: Optional[str] = None, username: Optional[str] = None) -> bool:
+    """Переносит новый email/username пользователя в каталог шардов; False - уже заняты.
+
+    Без шардирования уникальность держат индексы users - всегда True.
+    """
+    if not shards.enabled:
+        return True
+    values = {
+        field: value for field, value in identity_values(email=email, username=username).items()
+        if field.endswith("_normalized")
+    }
+    try:
+        with db.begin_nested():
+            db.execute(update(UserDirectory).where(UserDirectory.id == user_id).values(**values))
+    except IntegrityError:
+        return False
+    return True
+
+def release_identity(db: Session, user_id: int) -> None:
+    """Освобождает email/username удаленного аккаунта в каталоге шардов (id не переиспользуется)"""
+    if shards.enabled:
+        db.execute(update(UserDirectory).where(UserDirectory.id == user_id).values(
+            email_normalized=None, username_normalized=None
+        ))
+
+def insert_user(db: Session, values: dict) -> Optional[dict]:
+    """Вставляет пользователя одним запросом и возвращает колонки UserResponse.
+
+    На PostgreSQL и SQLite это INSERT ... ON CONFLICT DO NOTHING RETURNING,
+    на прочих диалектах - обычный INSERT с перехватом IntegrityError.
+    При шардировании id выдает каталог - он же проверяет уникальность по всем шардам;
+    если коммит сессии не удался, вызывающий снимает резерв через discard_user_id.
+    Возвращает None, если username или email уже заняты.
+    """
+    if not shards.enabled:
+        return _insert_user_row(db, values)
+    
+    user_id = allocate_user_id(values)
+    if user_id is None:
+        return None
+    try:
+        row = _insert_user_row(db, {**values, "id": user_id})
+    except Exception:
+        discard_user_id(user_id)
+        raise
+    if row is None:
+        discard_user_id(user_id)
+    return row
+
+def _insert_user_row(db: Session, values: dict) -> Optional[dict]:
+    dialect_insert = get_dialect_insert(db)
+    
+    if dialect_insert is not None:
+        stmt = dialect_insert(User).values(**values).on_conflict_do_nothing()
+        row = db.execute(stmt.returning(*USER_RESPONSE_COLUMNS)).mappings().first()
+        return dict(row) if row else None
+    
+    try:
+        with db.begin_nested():
+            row = db.execute(
+                insert(User).values(**values).returning(*USER_RESPONSE_COLUMNS)
+            ).mappings().first()
+    except IntegrityError:
+        return None
+    return dict(row)
+
+# Правила приватности профиля, компилируемые в проекции строка -> dict
+PROFILE_BASE_FIELDS = (
+    "id", "username", "first_name", "last_name", "bio", "avatar_url",
+    "location", "website", "company", "job_title", "created_at"
+)
+PROFILE_CONTACT_FIELDS = (
+    ("email", "show_email"),
+    ("phone", "show_phone"),
+    ("birth_date", "show_birth_date"),
+)
+PRIVATE_PROFILE_BIO = "Профиль скрыт"
+PRIVATE_HIDDEN_FIELDS = ("location", "website", "company", "job_title")
+
+class ProfileProjection(NamedTuple):
+    columns: tuple
+    project: Callable[[dict], dict]
+
+def compile_profile_projection(relation: str) -> ProfileProjection:
+    """Компилирует правила приватности для отношения зрителя к профилю.
+
+    relation - "owner" (владелец), "public"/"private" (видимость профиля для
+    постороннего), "friends" (профиль только для друзей, зритель - друг)
+    или "restricted" (прочие значения видимости).
+    Возвращает колонки, которые нужно выбрать, и функцию проекции строки.
+    """
+    if relation in ("owner", "public", "friends"):
+        # Контакты показываются по флагам show_*
+        shown = PROFILE_BASE_FIELDS
+        gated = PROFILE_CONTACT_FIELDS
+        constants = {}
+    elif relation == "private":
+        # Для приватного профиля показываем только базовую информацию
+        shown = tuple(f for f in PROFILE_BASE_FIELDS if f not in PRIVATE_HIDDEN_FIELDS + ("bio",))
+        gated = ()
+        constants = dict.fromkeys(PRIVATE_HIDDEN_FIELDS + ("email", "phone", "birth_date"))
+        constants["bio"] = PRIVATE_PROFILE_BIO
+    else:
+        shown = PROFILE_BASE_FIELDS
+        gated = ()
+        constants = dict.fromkeys(("email", "phone", "birth_date"))
+    
+    column_names = shown + tuple(name for pair in gated for name in pair)
+    columns = tuple(User.__table__.c[name] for name in column_names)
+    
+    def project(row) -> dict:
+        data = {field: row[field] for field in shown}
+        for field, flag in gated:
+            data[field] = row[field] if row[flag] else None
+        data.update(constants)
+        return data
+    
+    return ProfileProjection(columns, project)
+
+PROFILE_PROJECTIONS = {
+    relation: compile_profile_projection(relation)
+    for relation in ("owner", "public", "private", "friends", "restricted")
+}
+
+def get_profile_projection(
+    visibility: Optional[str], is_owner: bool = False, is_friend: bool = False
+) -> ProfileProjection:
+    if is_owner:
+        return PROFILE_PROJECTIONS["owner"]
+    if visibility == "friends":
+        # Не-друг видит профиль "только для друзей" как приватный
+        return PROFILE_PROJECTIONS["friends" if is_friend else "private"]
+    return PROFILE_PROJECTIONS.get(visibility, PROFILE_PROJECTIONS["restricted"])
+
+def project_user_profile(row, viewer_id: Optional[int] = None, friend_ids: AbstractSet[int] = frozenset()) -> dict:
+    """Проекция одной строки (колонки PUBLIC_PROFILE_COLUMNS) по правилам приватности"""
+    projection = get_profile_projection(
+        row["profile_visibility"], row["id"] == viewer_id, row["id"] in friend_ids
+    )
+    return projection.project(row)
+
+def project_user_profiles(
+    rows, viewer_id: Optional[int] = None, friend_ids: AbstractSet[int] = frozenset()
+) -> List[dict]:
+    """Пакетная проекция списка строк.
+
+    friend_ids - друзья зрителя среди строк (follows.friends_among, один запрос
+    на страницу); проекция каждой строки - из кеша скомпилированных проекций.
+    """
+    return [project_user_profile(row, viewer_id, friend_ids) for row in rows]
+
+def filter_user_profile(
+    user: User, viewer: Optional[User] = None, friend_ids: AbstractSet[int] = frozenset()
+) -> UserPublicProfile:
+    """Фильтрует профиль пользователя в зависимости от настроек приватности"""
+    row = {column.key: getattr(user, column.key) for column in PUBLIC_PROFILE_COLUMNS}
+    return UserPublicProfile(**project_user_profile(row, viewer.id if viewer else None, friend_ids))
@@ -0,0 +1,273 @@
+from fastapi import Request
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, sessionmaker
+from typing import Optional, Iterable, List, Dict
+import bisect
+import hashlib
+import itertools
+import threading
+import time
+
+from config import (
+    DATABASE_URL, DATABASE_REPLICA_URLS, REPLICA_MAX_LAG_SECONDS,
+    REPLICA_HEALTH_CHECK_SECONDS, REPLICA_CONNECT_TIMEOUT, READ_YOUR_WRITES_SECONDS,
+    DATABASE_SHARD_URLS, SHARD_VIRTUAL_NODES
+)
+
+# Движок создается лениво при первом обращении, а не при импорте модуля
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+Base = declarative_base()
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> Engine:
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(DATABASE_URL)
+    return _engine
+
+class ReplicaSet:
+    """Read-реплики с round-robin выбором и проверкой здоровья и отставания.
+
+    Проверка выполняется не чаще раза в REPLICA_HEALTH_CHECK_SECONDS на реплику;
+    недоступная или отстающая реплика пропускается до следующей проверки.
+    Реплику проверяет один запрос, остальные в это время используют прошлый
+    результат; подключение ограничено connect_timeout.
+    """
+    
+    def __init__(self, urls: List[str], max_lag: float, check_interval: float, connect_timeout: float):
+        self.urls = list(urls)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self._engines: Dict[str, Engine] = {}
+        self._state: Dict[str, dict] = {}
+        self._probe_locks = {url: threading.Lock() for url in self.urls}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.urls)
+    
+    def engine(self, url: str) -> Engine:
+        engine = self._engines.get(url)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(url)
+                if engine is None:
+                    connect_args = {}
+                    if make_url(url).get_backend_name() == "postgresql":
+                        connect_args["connect_timeout"] = max(1, int(self.connect_timeout))
+                    engine = self._engines[url] = create_engine(url, connect_args=connect_args)
+        return engine
+    
+    def _probe(self, url: str) -> dict:
+        engine = self.engine(url)
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.name == "postgresql":
+                    # Все полученное уже применено - реплика догнала основную БД, даже если
+                    # последняя транзакция была давно (основная БД простаивает)
+                    lag = conn.execute(text(
+                        "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+                        "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                        "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                    )).scalar()
+                else:
+                    conn.execute(text("SELECT 1"))
+                    lag = 0
+            state = {"healthy": True, "lag": float(lag or 0)}
+        except Exception as e:
+            print(f"Реплика {engine.url!r} недоступна: {str(e)}")
+            state = {"healthy": False, "lag": None}
+        state["checked_at"] = time.monotonic()
+        self._state[url] = state
+        return state
+    
+    def is_usable(self, url: str) -> bool:
+        state = self._state.get(url)
+        if state is None or time.monotonic() - state["checked_at"] > self.check_interval:
+            lock = self._probe_locks[url]
+            if lock.acquire(blocking=False):
+                try:
+                    state = self._probe(url)
+                finally:
+                    lock.release()
+            elif state is None:
+                # Первая проверка еще идет в другом запросе - читаем из основной БД
+                return False
+        return state["healthy"] and state["lag"] <= self.max_lag
+    
+    def pick(self) -> Optional[Engine]:
+        """Следующая пригодная реплика по кругу или None (тогда читаем из основной БД)"""
+        start = next(self._counter)
+        for offset in range(len(self.urls)):
+            url = self.urls[(start + offset) % len(self.urls)]
+            if self.is_usable(url):
+                return self.engine(url)
+        return None
+    
+    def status(self) -> List[dict]:
+        return [
+            {"url": repr(self.engine(url).url), **self._state.get(url, {})}
+            for url in self.urls
+        ]
+    
+    def dispose(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+            self._state.clear()
+
+replicas = ReplicaSet(
+    DATABASE_REPLICA_URLS, REPLICA_MAX_LAG_SECONDS, REPLICA_HEALTH_CHECK_SECONDS, REPLICA_CONNECT_TIMEOUT
+)
+
+# Таблицы на шардах и колонка с id пользователя, по которой выбирается шард строки;
+# outbox_events лежит рядом с пользователем - событие пишется в той же транзакции
+SHARD_KEYS: Dict[str, str] = {
+    "users": "id",
+    "refresh_tokens": "user_id",
+    "outbox_events": "aggregate_id",
+}
+GLOBAL_SHARD = "global"
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class ShardMap:
+    """Консистентное хеширование id пользователя на шарды.
+
+    Каждый шард занимает virtual_nodes точек кольца; при добавлении шарда
+    переезжает примерно 1/N пользователей (см. reshard.py).
+    """
+    
+    def __init__(self, urls: Dict[str, str], virtual_nodes: int):
+        if GLOBAL_SHARD in urls:
+            raise ValueError(f"Имя шарда '{GLOBAL_SHARD}' зарезервировано за общей БД")
+        self.urls = dict(urls)
+        ring = sorted((ring_hash(f"{name}#{node}"), name) for name in self.urls for node in range(virtual_nodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [name for _, name in ring]
+        self._engines: Dict[str, Engine] = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.urls)
+    
+    @property
+    def names(self) -> List[str]:
+        return list(self.urls)
+    
+    def shard_for(self, user_id: int) -> str:
+        index = bisect.bisect(self._points, ring_hash(str(user_id))) % len(self._points)
+        return self._owners[index]
+    
+    def engine(self, name: str) -> Engine:
+        engine = self._engines.get(name)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(name)
+                if engine is None:
+                    engine = self._engines[name] = create_engine(self.urls[name])
+        return engine
+    
+    def engines(self) -> Dict[str, Engine]:
+        return {name: self.engine(name) for name in self.urls}
+    
+    def group(self, user_ids: Iterable[int]) -> Dict[str, List[int]]:
+        """id пользователей по шардам; без шардирования - все в общей БД"""
+        groups: Dict[str, List[int]] = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id) if self.enabled else GLOBAL_SHARD, []).append(user_id)
+        return groups
+    
+    def dispose(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+shards = ShardMap(DATABASE_SHARD_URLS, SHARD_VIRTUAL_NODES)
+
+def user_data_engines() -> Dict[str, Engine]:
+    """БД с таблицами SHARD_KEYS: все шарды или одна основная БД"""
+    return shards.engines() if shards.enabled else {GLOBAL_SHARD: get_engine()}
+
+def open_session() -> Session:
+    """Сессия основной БД; при шардировании - маршрутизирующая по шардам (sharding.py)"""
+    if shards.enabled:
+        from sharding import create_sharded_session
+        return create_sharded_session()
+    return SessionLocal(bind=get_engine())
+
+# Read-your-writes: после успешной записи клиент получает cookie и какое-то время читает из основной БД
+READ_METHODS = frozenset({"GET", "HEAD"})
+PRIMARY_STICKY_COOKIE = "db_primary_until"
+
+def is_sticky_to_primary(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(PRIMARY_STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def primary_sticky_cookie() -> bytes:
+    until = time.time() + READ_YOUR_WRITES_SECONDS
+    return (
+        f"{PRIMARY_STICKY_COOKIE}={until:.0f}; Max-Age={READ_YOUR_WRITES_SECONDS}; "
+        f"Path=/; HttpOnly; SameSite=lax"
+    ).encode("latin-1")
+
+def dispose_engine() -> None:
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+    replicas.dispose()
+    shards.dispose()
+
+def create_schema() -> None:
+    """Создает таблицы (только по явному запросу - CREATE_SCHEMA или create_app(create_schema=True))"""
+    import models  # noqa: F401 - регистрирует модели в Base.metadata
+    if not shards.enabled:
+        Base.metadata.create_all(bind=get_engine())
+        return
+    tables = Base.metadata.sorted_tables
+    Base.metadata.create_all(bind=get_engine(), tables=[t for t in tables if t.name not in SHARD_KEYS])
+    for engine in shards.engines().values():
+        Base.metadata.create_all(bind=engine, tables=[t for t in tables if t.name in SHARD_KEYS])
+
+def prewarm_pool(connections: int) -> int:
+    """Открывает несколько соединений пула заранее; возвращает число прогретых"""
+    engine = get_engine()
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            conn.execute(text("SELECT 1"))
+            opened.append(conn)
+    finally:
+        for conn in opened:
+            conn.close()
+    return len(opened)
+
+# Database dependency: GET/HEAD идут на реплику (если есть и клиент не "прилип" к основной БД);
+# при шардировании реплики не используются - сессия маршрутизирует запросы по шардам
+def get_db(request: Request):
+    engine = None
+    if replicas.enabled and not shards.enabled and request.method in READ_METHODS and not is_sticky_to_primary(request):
+        engine = replicas.pick()
+    db = SessionLocal(bind=engine) if engine is not None else open_session()
+    try:
+        yield db
+    finally:
+        db.close()
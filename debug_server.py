@@ -1,6 +1,11 @@
 # Скрипт для отладки сервера
+import os
 import uvicorn
 import logging
+
+# В режиме отладки создаем таблицы при старте
+os.environ.setdefault("CREATE_SCHEMA", "true")
+
 from main import app
 
 # Настройка логирования
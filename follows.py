@@ -0,0 +1,147 @@
+"""Граф подписок и проверки дружбы для видимости "friends".
+
+Друзья - взаимные подписки (follows в обе стороны). Для страницы профилей
+друзья зрителя определяются одним запросом (friends_among); у частых зрителей
+множество друзей целиком кешируется в памяти воркера на FRIENDS_CACHE_TTL_SECONDS.
+Функции записи не коммитят и не трогают кеш: вызывающий сбрасывает
+friend_cache.invalidate(...) после успешного db.commit().
+"""
+from collections import OrderedDict
+from sqlalchemy import and_, delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+import threading
+import time
+
+from config import (
+    FRIENDS_CACHE_SIZE, FRIENDS_CACHE_TTL_SECONDS, FRIENDS_CACHE_HOT_THRESHOLD, FRIENDS_CACHE_MAX_FRIENDS
+)
+from database import shards
+from models import Follow
+from crud import get_dialect_insert
+
+def friend_ids_select(user_id: int, among: Optional[Iterable[int]] = None):
+    """SELECT id друзей пользователя (взаимные подписки), опционально только среди among"""
+    outgoing = aliased(Follow)
+    incoming = aliased(Follow)
+    stmt = select(outgoing.followee_id).join(incoming, and_(
+        incoming.follower_id == outgoing.followee_id,
+        incoming.followee_id == outgoing.follower_id,
+    )).where(outgoing.follower_id == user_id)
+    if among is not None:
+        stmt = stmt.where(outgoing.followee_id.in_(list(among)))
+    return stmt
+
+def get_friend_ids(db: Session, user_id: int) -> FrozenSet[int]:
+    return frozenset(db.execute(friend_ids_select(user_id)).scalars())
+
+def friend_ids_filter(db: Session, user_id: int):
+    """Значение для User.id.in_(...): подзапрос по follows или, при шардировании
+    (follows в общей БД, users на шардах), готовый список id друзей"""
+    if shards.enabled:
+        return sorted(get_friend_ids(db, user_id))
+    return friend_ids_select(user_id)
+
+
+class FriendSetCache:
+    """LRU множеств друзей для частых зрителей.
+
+    Зритель попадает в кеш после hot_threshold обращений за ttl; множества
+    больше max_friends не кешируются - для них дешевле запрос по странице.
+    Кеш у каждого воркера свой: invalidate сбрасывает только кеш этого воркера,
+    в остальных изменение дружбы (и доступ к профилям "friends") становится
+    видно не позже чем через ttl (FRIENDS_CACHE_TTL_SECONDS).
+    """
+
+    def __init__(self, max_viewers: int, ttl: float, hot_threshold: int, max_friends: int):
+        self.max_viewers = max_viewers
+        self.ttl = ttl
+        self.hot_threshold = hot_threshold
+        self.max_friends = max_friends
+        self._sets: "OrderedDict[int, Tuple[float, FrozenSet[int]]]" = OrderedDict()
+        self._lookups: Dict[int, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, viewer_id: int) -> Optional[FrozenSet[int]]:
+        with self._lock:
+            entry = self._sets.get(viewer_id)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self._sets.move_to_end(viewer_id)
+            return entry[1]
+
+    def is_hot(self, viewer_id: int) -> bool:
+        """Учитывает обращение зрителя; True, если пора кешировать его друзей"""
+        now = time.monotonic()
+        with self._lock:
+            since, count = self._lookups.get(viewer_id, (now, 0))
+            if now - since > self.ttl:
+                since, count = now, 0
+            self._lookups[viewer_id] = (since, count + 1)
+            if len(self._lookups) > self.max_viewers * 4:
+                self._lookups = {
+                    key: value for key, value in self._lookups.items() if now - value[0] <= self.ttl
+                }
+            return count + 1 >= self.hot_threshold
+
+    def put(self, viewer_id: int, friend_ids: FrozenSet[int]) -> None:
+        if len(friend_ids) > self.max_friends:
+            return
+        with self._lock:
+            self._sets[viewer_id] = (time.monotonic() + self.ttl, friend_ids)
+            self._sets.move_to_end(viewer_id)
+            while len(self._sets) > self.max_viewers:
+                self._sets.popitem(last=False)
+
+    def invalidate(self, *user_ids: int) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._sets.pop(user_id, None)
+
+friend_cache = FriendSetCache(
+    FRIENDS_CACHE_SIZE, FRIENDS_CACHE_TTL_SECONDS, FRIENDS_CACHE_HOT_THRESHOLD, FRIENDS_CACHE_MAX_FRIENDS
+)
+
+def friends_among(db: Session, viewer_id: int, user_ids: Iterable[int]) -> FrozenSet[int]:
+    """Кто из user_ids - друг зрителя: из кеша или одним запросом на всю страницу"""
+    candidates = frozenset(user_ids) - {viewer_id}
+    if not candidates:
+        return frozenset()
+
+    cached = friend_cache.get(viewer_id)
+    if cached is not None:
+        return cached & candidates
+
+    if friend_cache.is_hot(viewer_id):
+        friend_ids = get_friend_ids(db, viewer_id)
+        friend_cache.put(viewer_id, friend_ids)
+        return friend_ids & candidates
+
+    return frozenset(db.execute(friend_ids_select(viewer_id, among=candidates)).scalars())
+
+def follow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """Подписка (идемпотентно); True, если подписка создана. Коммит - на вызывающем"""
+    values = {"follower_id": follower_id, "followee_id": followee_id}
+    dialect_insert = get_dialect_insert(db)
+    if dialect_insert is not None:
+        created = db.execute(dialect_insert(Follow).values(**values).on_conflict_do_nothing()).rowcount > 0
+    else:
+        try:
+            with db.begin_nested():
+                db.execute(insert(Follow).values(**values))
+            created = True
+        except IntegrityError:
+            created = False
+    return created
+
+def unfollow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """Отписка; True, если подписка была. Коммит - на вызывающем"""
+    result = db.execute(delete(Follow).where(
+        Follow.follower_id == follower_id, Follow.followee_id == followee_id
+    ))
+    return result.rowcount > 0
+
+def remove_user_edges(db: Session, *user_ids: int) -> None:
+    """Удаляет все подписки пользователей и на них (при удалении аккаунтов)"""
+    db.execute(delete(Follow).where(Follow.follower_id.in_(user_ids) | Follow.followee_id.in_(user_ids)))
@@ -0,0 +1,300 @@
+"""Idempotency-Key для изменяющих запросов: повтор с тем же ключом получает
+сохраненный ответ, а не выполняет запрос (bcrypt, запись файла, ротацию токенов) заново.
+
+Ключ действует в пределах метода, пути и учетных данных клиента. Одновременные
+повторы ждут завершения первого запроса. Ответы 5xx не сохраняются - их можно повторить.
+В общей таблице выполняющийся запрос держит ключ на время аренды
+IDEMPOTENCY_LEASE_SECONDS: ключ воркера, умершего до сохранения ответа, займет повтор.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.datastructures import Headers
+from starlette.requests import cookie_parser
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Dict, FrozenSet, NamedTuple, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import time
+
+from config import (
+    IDEMPOTENCY_BACKEND, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES,
+    IDEMPOTENCY_WAIT_SECONDS, IDEMPOTENCY_LEASE_SECONDS, IDEMPOTENCY_MAX_BODY_SIZE
+)
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+
+# Маршруты, которые клиенты повторяют при сетевых сбоях
+IDEMPOTENT_ROUTES: FrozenSet[Tuple[str, str]] = frozenset({
+    ("POST", "/users/"),
+    ("POST", "/profile/me/avatar"),
+    ("POST", "/auth/refresh"),
+})
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: str
+    # None - первый запрос с этим ключом еще выполняется
+    status: Optional[int] = None
+    headers: Tuple[Tuple[bytes, bytes], ...] = ()
+    body: bytes = b""
+
+
+class MemoryIdempotencyStore:
+    """LRU в памяти процесса: ключи видны только этому воркеру"""
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_MAX_ENTRIES, ttl: float = IDEMPOTENCY_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, StoredResponse]]" = OrderedDict()
+
+    async def claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """Занимает ключ (None) или возвращает уже существующую запись"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry[1]
+        self._entries[key] = (time.monotonic() + self.ttl, StoredResponse(fingerprint))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return None
+
+    async def complete(self, key: str, response: StoredResponse) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+
+    async def release(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+
+class DatabaseIdempotencyStore:
+    """Таблица idempotency_keys: ключи общие для всех воркеров и переживают рестарт"""
+
+    # Раз в столько захватов удаляются все истекшие ключи, а не только текущий
+    purge_every = 1000
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL_SECONDS, lease: float = IDEMPOTENCY_LEASE_SECONDS):
+        self.ttl = ttl
+        self.lease = lease
+        self._claims = 0
+
+    def _claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        from database import get_engine
+        from models import IdempotencyKey
+
+        now = datetime.utcnow()
+        with get_engine().begin() as conn:
+            # Истекший ключ или брошенный (аренда вышла, ответа нет) можно занять заново
+            self._claims += 1
+            expired = (IdempotencyKey.expires_at < now) | (
+                IdempotencyKey.status_code.is_(None) & (IdempotencyKey.locked_until < now)
+            )
+            if self._claims % self.purge_every:
+                expired = expired & (IdempotencyKey.key == key)
+            conn.execute(delete(IdempotencyKey).where(expired))
+            # Пока ответа нет, ключ живет только до конца аренды; полный TTL - после complete
+            locked_until = now + timedelta(seconds=self.lease)
+            try:
+                with conn.begin_nested():
+                    conn.execute(insert(IdempotencyKey).values(
+                        key=key,
+                        fingerprint=fingerprint,
+                        created_at=now,
+                        locked_until=locked_until,
+                        expires_at=locked_until
+                    ))
+                return None
+            except IntegrityError:
+                row = conn.execute(select(
+                    IdempotencyKey.fingerprint, IdempotencyKey.status_code,
+                    IdempotencyKey.headers, IdempotencyKey.body
+                ).where(IdempotencyKey.key == key)).first()
+        if row is None:
+            return StoredResponse(fingerprint)
+        headers = tuple((name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(row.headers or "[]"))
+        return StoredResponse(row.fingerprint, row.status_code, headers, row.body or b"")
+
+    def _complete(self, key: str, response: StoredResponse) -> None:
+        from database import get_engine
+        from models import IdempotencyKey
+
+        headers = json.dumps([(name.decode("latin-1"), value.decode("latin-1")) for name, value in response.headers])
+        with get_engine().begin() as conn:
+            conn.execute(update(IdempotencyKey).where(IdempotencyKey.key == key).values(
+                status_code=response.status, headers=headers, body=response.body,
+                locked_until=None, expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)
+            ))
+
+    def _release(self, key: str) -> None:
+        from database import get_engine
+        from models import IdempotencyKey
+
+        with get_engine().begin() as conn:
+            conn.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+
+    async def claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        return await run_in_threadpool(self._claim, key, fingerprint)
+
+    async def complete(self, key: str, response: StoredResponse) -> None:
+        await run_in_threadpool(self._complete, key, response)
+
+    async def release(self, key: str) -> None:
+        await run_in_threadpool(self._release, key)
+
+
+def request_fingerprint(headers: Headers, body: bytes) -> str:
+    """Хеш тела запроса; из multipart убирается boundary - клиенты генерируют его заново при повторе"""
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/"):
+        for param in content_type.split(";")[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "boundary" and value:
+                body = body.replace(value.strip('"').encode("latin-1"), b"")
+    return hashlib.sha256(body).hexdigest()
+
+def create_idempotency_store(backend: str = IDEMPOTENCY_BACKEND):
+    if backend == "database":
+        return DatabaseIdempotencyStore()
+    return MemoryIdempotencyStore()
+
+
+class IdempotencyMiddleware:
+    """Сохраняет ответы запросов с Idempotency-Key и отдает их повторам.
+
+    Повтор с другим телом запроса получает 422; если первый запрос не завершился
+    за wait_seconds - 409, клиент может повторить позже.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        store=None,
+        routes: FrozenSet[Tuple[str, str]] = IDEMPOTENT_ROUTES,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+        max_body_size: int = IDEMPOTENCY_MAX_BODY_SIZE
+    ):
+        self.app = app
+        self.store = store if store is not None else create_idempotency_store()
+        self.routes = routes
+        self.wait_seconds = wait_seconds
+        self.max_body_size = max_body_size
+        # Запросы этого воркера в работе: повторы ждут событие, а не опрашивают хранилище
+        self._in_progress: Dict[str, asyncio.Event] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        idempotency_key = headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+
+        # Тело читаем целиком: по нему отличаем повтор от другого запроса с тем же ключом
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        # Учетные данные клиента, а не весь Cookie: служебные cookie (read-your-writes) меняются между повторами
+        cookies = cookie_parser(headers.get("cookie", ""))
+        principal = "|".join((
+            headers.get("authorization", ""), cookies.get("access_token", ""), cookies.get("refresh_token", "")
+        ))
+        key = hashlib.sha256(
+            f"{scope['method']} {scope['path']}\n{principal}\n{idempotency_key}".encode()
+        ).hexdigest()
+        fingerprint = request_fingerprint(headers, body)
+
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            stored = await self.store.claim(key, fingerprint)
+            if stored is None:
+                break
+            if stored.fingerprint != fingerprint:
+                await JSONResponse(
+                    {"detail": "Idempotency-Key was already used with a different request"},
+                    status_code=422
+                )(scope, receive, send)
+                return
+            if stored.status is not None:
+                await send({
+                    "type": "http.response.start",
+                    "status": stored.status,
+                    "headers": list(stored.headers) + [(b"idempotent-replayed", b"true")],
+                })
+                await send({"type": "http.response.body", "body": stored.body})
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is still in progress"},
+                    status_code=409
+                )(scope, receive, send)
+                return
+            event = self._in_progress.get(key)
+            try:
+                if event is not None:
+                    await asyncio.wait_for(event.wait(), timeout=remaining)
+                else:
+                    # Первый запрос выполняет другой воркер - опрашиваем общее хранилище
+                    await asyncio.sleep(min(0.1, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+        event = self._in_progress[key] = asyncio.Event()
+        body_sent = False
+
+        async def receive_wrapper() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response_start: Optional[Message] = None
+        response_body = []
+        response_size = 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_start, response_size
+            if message["type"] == "http.response.start":
+                response_start = message
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+                if response_size <= self.max_body_size:
+                    response_body.append(message.get("body", b""))
+            await send(message)
+
+        completed = False
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+            if (
+                response_start is not None
+                and response_start["status"] < 500
+                and response_size <= self.max_body_size
+            ):
+                await self.store.complete(key, StoredResponse(
+                    fingerprint,
+                    response_start["status"],
+                    tuple(response_start.get("headers", ())),
+                    b"".join(response_body)
+                ))
+                completed = True
+        finally:
+            if not completed:
+                await self.store.release(key)
+            del self._in_progress[key]
+            event.set()
@@ -0,0 +1,66 @@
+"""Жизненный цикл воркера: учет запросов в работе, дренаж и плавная остановка.
+
+Последовательность при SIGTERM (см. serve.DrainingServer):
+  1. readiness начинает отвечать 503, запросы еще обслуживаются SHUTDOWN_DRAIN_DELAY с -
+     балансировщик успевает убрать воркер из ротации;
+  2. uvicorn перестает принимать соединения и ждет запросы в работе до SHUTDOWN_TIMEOUT;
+  3. lifespan приложения останавливает фоновые задачи, закрывает пул БД и печатает итог.
+"""
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import time
+
+# Режим дренажа: readiness отвечает 503, ответы закрывают keep-alive соединения
+_draining = False
+_requests = {"in_flight": 0, "total": 0, "drained": 0, "aborted": 0}
+
+def is_draining() -> bool:
+    return _draining
+
+def set_draining(value: bool = True) -> None:
+    global _draining
+    _draining = value
+
+def request_stats() -> dict:
+    return dict(_requests, draining=_draining)
+
+async def wait_for_in_flight(timeout: float) -> int:
+    """Ждет завершения запросов в работе; возвращает, сколько не дождались"""
+    deadline = time.monotonic() + timeout
+    while _requests["in_flight"] and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return _requests["in_flight"]
+
+
+class InFlightMiddleware:
+    """Считает запросы в работе и завершенные во время дренажа.
+
+    Пока идет дренаж, ответы получают Connection: close - клиенты с keep-alive
+    переподключаются к другим воркерам, а не держат соединение с уходящим.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start" and _draining:
+                message["headers"] = list(message.get("headers", [])) + [(b"connection", b"close")]
+            await send(message)
+
+        _requests["in_flight"] += 1
+        _requests["total"] += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            _requests["aborted"] += 1
+            raise
+        else:
+            if _draining:
+                _requests["drained"] += 1
+        finally:
+            _requests["in_flight"] -= 1
@@ -0,0 +1,47 @@
+"""ASGI-middleware приложения (без BaseHTTPMiddleware - без лишней задачи на каждый запрос)"""
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import FrozenSet, List, Optional, Tuple
+import re
+
+from database import READ_METHODS, primary_sticky_cookie
+
+
+def compile_cors_origins(origins: List[str]) -> Tuple[FrozenSet[str], Optional[str]]:
+    """Делит CORS_ORIGINS на точные origin (множество, O(1) проверка) и одно
+    регулярное выражение для масок вида https://*.example.com.
+
+    "*" среди значений разрешает любой origin.
+    """
+    exact = set()
+    patterns = []
+    for origin in origins:
+        origin = origin.rstrip("/")
+        if origin == "*":
+            exact.add("*")
+        elif "*" in origin:
+            patterns.append(r"[^/.]+(?:\.[^/.]+)*".join(re.escape(part) for part in origin.split("*")))
+        else:
+            exact.add(origin)
+    regex = "|".join(f"(?:{pattern})" for pattern in patterns) or None
+    return frozenset(exact), regex
+
+
+class ReadYourWritesMiddleware:
+    """После успешного изменяющего запроса выставляет cookie, по которой
+    последующие чтения клиента какое-то время идут в основную БД, а не в реплику."""
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] in READ_METHODS:
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"set-cookie", primary_sticky_cookie())]
+            await send(message)
+        
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,182 @@
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Date, LargeBinary, Index
+from sqlalchemy.orm import deferred
+from datetime import datetime
+
+from database import Base
+
+# Database Models
+class User(Base):
+    __tablename__ = "users"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, nullable=False)
+    username = Column(String, nullable=False)
+    # Нормализованные (trim + lower) копии для поиска и уникальности без учета регистра;
+    # заполняются при записи (crud.normalize_identity), индексы - в __table_args__
+    email_normalized = Column(String, nullable=False)
+    username_normalized = Column(String, nullable=False)
+    hashed_password = Column(String, nullable=False)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Профильные поля
+    first_name = Column(String, nullable=True)
+    last_name = Column(String, nullable=True)
+    phone = Column(String, nullable=True)
+    birth_date = Column(Date, nullable=True)
+    # TEXT может быть большим - грузим только там, где он действительно нужен
+    bio = deferred(Column(Text, nullable=True))
+    avatar_url = Column(String, nullable=True)
+    location = Column(String, nullable=True)
+    website = Column(String, nullable=True)
+    company = Column(String, nullable=True)
+    job_title = Column(String, nullable=True)
+    
+    # Настройки приватности
+    profile_visibility = Column(String, default="public")
+    show_email = Column(Boolean, default=False)
+    show_phone = Column(Boolean, default=False)
+    show_birth_date = Column(Boolean, default=False)
+    
+    # Метаданные
+    last_login = Column(DateTime, nullable=True)
+    profile_updated_at = Column(DateTime, default=datetime.utcnow)
+    # Число заполненных полей из PROFILE_COMPLETENESS_FIELDS, поддерживается при записи профиля
+    profile_completeness = Column(Integer, default=0, nullable=False, index=True)
+    # Версия профиля для ETag/If-Match: увеличивается при каждом изменении
+    version = Column(Integer, default=1, nullable=False)
+    # Мягкое удаление: аккаунт скрыт сразу, строку и файлы позже удаляет purge.py
+    deleted_at = Column(DateTime, nullable=True)
+    
+    # Частичные индексы только по живым аккаунтам: удаленные не мешают повторной
+    # регистрации с тем же email/username и не раздувают индексы поиска
+    __table_args__ = (
+        Index("ix_users_email_live", "email_normalized", unique=True,
+              postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        Index("ix_users_username_live", "username_normalized", unique=True,
+              postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        Index("ix_users_live_visibility", "profile_visibility", "id",
+              postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)),
+        # Очередь на окончательное удаление - маленький индекс только по удаленным
+        Index("ix_users_deleted_at", "deleted_at",
+              postgresql_where=deleted_at.isnot(None), sqlite_where=deleted_at.isnot(None)),
+    )
+
+# Условие "аккаунт не удален" - добавляется ко всем чтениям пользователей
+LIVE_USER = User.deleted_at.is_(None)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    token = Column(String, unique=True, index=True, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    is_active = Column(Boolean, default=True)
+
+class ProfileStats(Base):
+    """Материализованные агрегаты по пользователям, пересчитываются периодически"""
+    __tablename__ = "profile_stats"
+    
+    metric = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False)
+    refreshed_at = Column(DateTime, nullable=False)
+
+class Follow(Base):
+    """Подписка follower -> followee; друзья - взаимные подписки.
+
+    Первичный ключ покрывает "на кого подписан", обратный индекс - "кто подписан";
+    проверка взаимности читает только индексы.
+    """
+    __tablename__ = "follows"
+    
+    follower_id = Column(Integer, primary_key=True)
+    followee_id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_follows_followee_follower", "followee_id", "follower_id"),
+    )
+
+# Поля, по которым считается заполненность профиля
+PROFILE_COMPLETENESS_FIELDS = (
+    "first_name", "last_name", "phone", "birth_date", "bio",
+    "location", "website", "company", "job_title", "avatar_url"
+)
+
+# Наборы колонок для load_only по эндпоинтам
+AUTH_COLUMNS = (User.id, User.username, User.hashed_password, User.is_active, User.last_login)
+ME_COLUMNS = (
+    User.id, User.username, User.email, User.is_active, User.created_at,
+    User.first_name, User.last_name
+)
+PUBLIC_PROFILE_COLUMNS = (
+    User.id, User.username, User.first_name, User.last_name, User.bio,
+    User.avatar_url, User.location, User.website, User.company, User.job_title,
+    User.created_at, User.email, User.phone, User.birth_date,
+    User.profile_visibility, User.show_email, User.show_phone, User.show_birth_date
+)
+
+# Колонки UserResponse в порядке полей модели - для чтения без ORM
+USER_RESPONSE_COLUMNS = tuple(
+    User.__table__.c[name] for name in (
+        "id", "email", "username", "is_active", "created_at",
+        "first_name", "last_name", "phone", "birth_date", "bio",
+        "avatar_url", "location", "website", "company", "job_title",
+        "profile_visibility", "show_email", "show_phone", "show_birth_date",
+        "last_login", "profile_updated_at",
+    )
+)
+
+# Сохраненные ответы для Idempotency-Key (IDEMPOTENCY_BACKEND=database)
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    # sha256 от метода, пути, учетных данных клиента и самого ключа
+    key = Column(String(64), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    # NULL - первый запрос еще выполняется
+    status_code = Column(Integer, nullable=True)
+    headers = Column(Text, nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # До какого момента ключ занят выполняющимся запросом; после - его может занять повтор
+    locked_until = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class OutboxEvent(Base):
+    """События жизненного цикла пользователя; пишутся в транзакции изменения (outbox.py)"""
+    __tablename__ = "outbox_events"
+    
+    id = Column(Integer, primary_key=True)
+    event_type = Column(String(64), nullable=False)
+    aggregate_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # NULL - событие еще не доставлено
+    dispatched_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    
+    # Очередь диспетчера - только недоставленные события; доставленные не раздувают индекс
+    __table_args__ = (
+        Index("ix_outbox_events_pending", "next_attempt_at", "id",
+              postgresql_where=dispatched_at.is_(None), sqlite_where=dispatched_at.is_(None)),
+    )
+
+class UserDirectory(Base):
+    """Каталог пользователей в общей БД при шардировании (sharding.py).
+    
+    Выдает глобальные id (строки не удаляются - id не переиспользуются) и держит
+    уникальность email/username среди живых аккаунтов всех шардов; у удаленного
+    аккаунта нормализованные значения обнуляются.
+    """
+    __tablename__ = "user_directory"
+    __table_args__ = {"sqlite_autoincrement": True}
+    
+    id = Column(Integer, primary_key=True)
+    email_normalized = Column(String, nullable=True, unique=True)
+    username_normalized = Column(String, nullable=True, unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,236 @@
+"""Transactional outbox: события жизненного цикла пользователя для других сервисов.
+
+record_event добавляет строку outbox_events в ту же сессию, что и само изменение, -
+событие фиксируется тем же коммитом или не фиксируется вовсе. Фоновый диспетчер
+забирает пачку короткой транзакцией (FOR UPDATE SKIP LOCKED - воркеры не мешают
+друг другу): сдвигает next_attempt_at на OUTBOX_CLAIM_SECONDS вперед и коммитит.
+Отправка в sink идет без открытой транзакции и блокировок строк; результат
+фиксируется второй короткой транзакцией, при ошибке пачка откладывается с
+экспоненциальной задержкой. Если воркер умер во время отправки, пачку после
+истечения аренды заберет другой.
+Доставка "хотя бы один раз": получатель отбрасывает повторы по id события
+(при шардировании outbox есть на каждом шарде - id уникален вместе с полем shard).
+"""
+from datetime import datetime, timedelta
+from fastapi.concurrency import run_in_threadpool
+from pathlib import Path
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+from typing import Callable, Dict, List, Optional
+import asyncio
+import json
+import threading
+import urllib.request
+
+from config import (
+    OUTBOX_SINK, OUTBOX_BATCH_SIZE, OUTBOX_POLL_SECONDS, OUTBOX_RETRY_BASE_SECONDS,
+    OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETENTION_SECONDS, OUTBOX_WEBHOOK_TIMEOUT, OUTBOX_CLAIM_SECONDS
+)
+from database import SessionLocal, GLOBAL_SHARD, user_data_engines
+from models import OutboxEvent
+
+def record_event(db: Session, event_type: str, user_id: int, payload: Optional[dict] = None) -> None:
+    """Добавляет событие в текущую транзакцию; коммит - на вызывающем"""
+    db.add(OutboxEvent(
+        event_type=event_type,
+        aggregate_id=user_id,
+        payload=json.dumps(payload or {}, default=str, ensure_ascii=False),
+    ))
+
+
+class FileSink:
+    """Пишет события построчно в JSON Lines файл (локальная замена получателя)"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def send(self, events: List[dict]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+class WebhookSink:
+    """POST пачки событий JSON-массивом; любой ответ не 2xx - ошибка доставки"""
+
+    def __init__(self, url: str, timeout: float = OUTBOX_WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events: List[dict]) -> None:
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(events, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f"Webhook ответил {response.status}")
+
+
+# Схема OUTBOX_SINK -> фабрика sink; новые получатели регистрируются здесь
+SINKS: Dict[str, Callable[[str], object]] = {
+    "file": lambda spec: FileSink(spec.split(":", 1)[1]),
+    "http": WebhookSink,
+    "https": WebhookSink,
+}
+
+def create_outbox_sink(spec: str = OUTBOX_SINK):
+    scheme = spec.split(":", 1)[0]
+    if scheme not in SINKS:
+        raise ValueError(f"Неизвестный OUTBOX_SINK: {spec}")
+    return SINKS[scheme](spec)
+
+def retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX_SECONDS)
+
+# Счетчики диспетчера этого воркера
+dispatch_stats = {"dispatched": 0, "failed_batches": 0, "last_dispatch_at": None, "last_error": None}
+
+def dispatch_batch(db: Session, sink, batch_size: int = OUTBOX_BATCH_SIZE, shard: str = GLOBAL_SHARD) -> int:
+    """Забирает и доставляет одну пачку из БД сессии; возвращает число доставленных событий"""
+    now = datetime.utcnow()
+    rows = db.execute(
+        select(OutboxEvent)
+        .where(OutboxEvent.dispatched_at.is_(None), OutboxEvent.next_attempt_at <= now)
+        .order_by(OutboxEvent.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not rows:
+        db.rollback()
+        return 0
+
+    ids = [row.id for row in rows]
+    attempts = {row.id: row.attempts for row in rows}
+    events = [
+        {
+            "id": row.id,
+            "type": row.event_type,
+            "user_id": row.aggregate_id,
+            "payload": json.loads(row.payload),
+            "created_at": row.created_at.isoformat(),
+        }
+        for row in rows
+    ]
+    if shard != GLOBAL_SHARD:
+        for event in events:
+            event["shard"] = shard
+
+    # Аренда: другие диспетчеры не возьмут пачку, пока она отправляется
+    db.execute(
+        update(OutboxEvent).where(OutboxEvent.id.in_(ids))
+        .values(next_attempt_at=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+    try:
+        sink.send(events)
+    except Exception as e:
+        # Пачка откладывается целиком - порядок событий внутри нее сохраняется
+        failed_at = datetime.utcnow()
+        db.execute(update(OutboxEvent), [
+            {
+                "id": event_id,
+                "attempts": attempts[event_id] + 1,
+                "next_attempt_at": failed_at + timedelta(seconds=retry_delay(attempts[event_id] + 1)),
+                "last_error": str(e)[:500],
+            }
+            for event_id in ids
+        ])
+        db.commit()
+        dispatch_stats["failed_batches"] += 1
+        dispatch_stats["last_error"] = str(e)
+        print(f"Outbox: доставка {len(ids)} событий не удалась ({str(e)}), "
+              f"повтор через {retry_delay(attempts[ids[0]] + 1):.0f} с")
+        return 0
+
+    dispatched_at = datetime.utcnow()
+    db.execute(
+        update(OutboxEvent).where(OutboxEvent.id.in_(ids)).values(dispatched_at=dispatched_at)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    dispatch_stats["dispatched"] += len(ids)
+    dispatch_stats["last_dispatch_at"] = dispatched_at.isoformat()
+    return len(ids)
+
+def delete_dispatched_events(db: Session, retention_seconds: float = OUTBOX_RETENTION_SECONDS) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=retention_seconds)
+    result = db.execute(delete(OutboxEvent).where(
+        OutboxEvent.dispatched_at.isnot(None), OutboxEvent.dispatched_at < cutoff
+    ))
+    db.commit()
+    return result.rowcount
+
+def outbox_metrics(db: Session) -> dict:
+    """Отставание outbox: сколько событий ждет доставки и возраст самого старого"""
+    # При шардировании - по строке с каждого шарда
+    rows = db.execute(
+        select(func.count(OutboxEvent.id), func.min(OutboxEvent.created_at))
+        .where(OutboxEvent.dispatched_at.is_(None))
+    ).all()
+    pending = sum(count for count, _ in rows)
+    oldest = min((created_at for _, created_at in rows if created_at is not None), default=None)
+    return {
+        "pending": pending,
+        "lag_seconds": round((datetime.utcnow() - oldest).total_seconds(), 3) if oldest else 0.0,
+        **dispatch_stats,
+    }
+
+def _dispatch_once(sink) -> int:
+    """По пачке с каждой БД пользователей; возвращает наибольшую из доставленных"""
+    dispatched = 0
+    for shard, engine in user_data_engines().items():
+        db = SessionLocal(bind=engine)
+        try:
+            dispatched = max(dispatched, dispatch_batch(db, sink, shard=shard))
+        except Exception as e:
+            print(f"Ошибка диспетчера outbox ({shard}): {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+    return dispatched
+
+def _cleanup_once() -> None:
+    for shard, engine in user_data_engines().items():
+        db = SessionLocal(bind=engine)
+        try:
+            delete_dispatched_events(db)
+        except Exception as e:
+            print(f"Ошибка очистки outbox ({shard}): {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+
+async def _dispatch_loop(sink) -> None:
+    polls = 0
+    while True:
+        # Полная пачка - сразу следующая, иначе ждем новых событий
+        while await run_in_threadpool(_dispatch_once, sink) >= OUTBOX_BATCH_SIZE:
+            pass
+        polls += 1
+        if polls % 3600 == 0:
+            await run_in_threadpool(_cleanup_once)
+        await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+_dispatch_task: Optional[asyncio.Task] = None
+
+def start_outbox_dispatcher() -> None:
+    global _dispatch_task
+    if OUTBOX_POLL_SECONDS > 0 and _dispatch_task is None:
+        _dispatch_task = asyncio.create_task(_dispatch_loop(create_outbox_sink()))
+
+async def stop_outbox_dispatcher() -> None:
+    global _dispatch_task
+    if _dispatch_task is not None:
+        _dispatch_task.cancel()
+        try:
+            await _dispatch_task
+        except asyncio.CancelledError:
+            pass
+        _dispatch_task = None
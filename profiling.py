@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Профилирование одного запроса по требованию.
+
+Включается PROFILING_ENABLED=true и PROFILING_SECRET. Профилируется только запрос
+с заголовком X-Profile-Request: "<expires>.<hmac_sha256(secret, 'expires:METHOD:path')>".
+Подпись для запроса можно получить так:
+
+    python profiling.py GET /profile/me
+
+Во время запроса семплер снимает стеки потоков, а события движков SQLAlchemy
+записывают SQL с длительностью. Стек event loop берется, только когда loop
+выполняет задачу профилируемого запроса. Потоки пула по стеку не отличить от
+чужих: если параллельно шли другие запросы (concurrent_requests в отчете), в графе
+могут быть и их стеки из пула. SQL относится к запросу точно - через contextvars.
+Отчет пишется в PROFILING_OUTPUT_DIR: <id>.folded (формат flamegraph.pl /
+speedscope) и <id>.json (SQL и сводка); id возвращается в заголовке X-Profile-Id,
+время - в Server-Timing.
+Когда профилирование выключено, middleware и слушатели событий не устанавливаются.
+"""
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+import asyncio
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import time
+import uuid
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import PROFILING_SECRET, PROFILING_OUTPUT_DIR, PROFILING_SAMPLE_INTERVAL_MS
+from lifecycle import request_stats
+
+PROFILE_HEADER = b"x-profile-request"
+
+# Профиль текущего запроса; пробрасывается и в потоки пула через contextvars
+_current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+def sign_profile_request(method: str, path: str, ttl: int = 300, secret: str = PROFILING_SECRET) -> str:
+    expires = int(time.time()) + ttl
+    message = f"{expires}:{method.upper()}:{path}".encode()
+    return f"{expires}.{hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()}"
+
+def verify_profile_signature(value: str, method: str, path: str, secret: str = PROFILING_SECRET) -> bool:
+    expires, _, signature = value.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    message = f"{expires}:{method.upper()}:{path}".encode()
+    expected = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class StackSampler(threading.Thread):
+    """Периодически снимает стеки потоков и считает их в свернутом (folded) виде.
+
+    Поток event loop семплируется, только пока loop выполняет task - задачу
+    профилируемого запроса (middleware приложения - чистые ASGI, запрос идет
+    в одной задаче); остальные семплы loop считаются в other_loop_samples.
+    """
+    
+    IDLE_FUNCTIONS = {"wait", "select", "poll", "get", "_worker", "run_forever", "_run_once"}
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop, task: asyncio.Task, loop_thread_id: int, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.loop = loop
+        self.task = task
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.other_loop_samples = 0
+        self._stopped = threading.Event()
+    
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id == self.loop_thread_id:
+                    # Loop простаивает или выполняет другой запрос
+                    if asyncio.current_task(self.loop) is not self.task:
+                        self.other_loop_samples += 1
+                        continue
+                # Простаивающие потоки пула только зашумляют граф
+                elif frame.f_code.co_name in self.IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+    
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.queries = []
+        self.started = time.perf_counter()
+        self.elapsed_ms = 0.0
+        self.status = None
+        # Другие запросы воркера, шедшие одновременно с этим
+        self.concurrent_requests = 0
+    
+    @property
+    def sql_ms(self) -> float:
+        return sum(query["duration_ms"] for query in self.queries)
+    
+    def save(self, stacks: Counter, other_loop_samples: int = 0) -> None:
+        output_dir = Path(PROFILING_OUTPUT_DIR)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / f"{self.id}.folded").write_text(
+            "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+        )
+        (output_dir / f"{self.id}.json").write_text(json.dumps({
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "elapsed_ms": round(self.elapsed_ms, 2),
+            "sql_ms": round(self.sql_ms, 2),
+            "samples": sum(stacks.values()),
+            "other_loop_samples": other_loop_samples,
+            "concurrent_requests": self.concurrent_requests,
+            "queries": self.queries,
+        }, indent=2, ensure_ascii=False))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None and conn.info.get("profile_query_start"):
+        started = conn.info["profile_query_start"].pop()
+        profile.queries.append({
+            "statement": statement,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "database": conn.engine.url.database,
+        })
+
+def install_sql_listeners() -> None:
+    """Слушатели на всех движках (основной и реплики); ставятся только при включенном профилировании"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class RequestProfilerMiddleware:
+    """Профилирует запросы с валидным X-Profile-Request; одновременно - не больше одного"""
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._busy = threading.Lock()
+        install_sql_listeners()
+    
+    def _requested(self, scope: Scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return verify_profile_signature(value.decode("latin-1"), scope["method"], scope["path"])
+        return False
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self._requested(scope) or not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+        
+        profile = RequestProfile(scope["method"], scope["path"])
+        sampler = StackSampler(
+            asyncio.get_running_loop(), asyncio.current_task(), threading.get_ident(),
+            PROFILING_SAMPLE_INTERVAL_MS / 1000
+        )
+        # Уже шедшие запросы (кроме этого) и начатые до его завершения
+        stats = request_stats()
+        started_in_flight, started_total = stats["in_flight"], stats["total"]
+        
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                elapsed = (time.perf_counter() - profile.started) * 1000
+                timing = f"app;dur={elapsed:.2f}, db;dur={profile.sql_ms:.2f};desc=\"{len(profile.queries)} queries\""
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.id.encode()),
+                    (b"server-timing", timing.encode()),
+                ]
+            await send(message)
+        
+        token = _current_profile.set(profile)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            _current_profile.reset(token)
+            profile.elapsed_ms = (time.perf_counter() - profile.started) * 1000
+            profile.concurrent_requests = max(started_in_flight - 1, 0) + request_stats()["total"] - started_total
+            self._busy.release()
+            try:
+                await run_in_threadpool(profile.save, sampler.stacks, sampler.other_loop_samples)
+            except OSError as e:
+                print(f"Не удалось сохранить профиль {profile.id}: {str(e)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or not PROFILING_SECRET:
+        sys.exit("Использование: PROFILING_SECRET=... python profiling.py METHOD PATH")
+    print(f"X-Profile-Request: {sign_profile_request(sys.argv[1], sys.argv[2])}")
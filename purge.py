@@ -0,0 +1,133 @@
+"""Фоновое окончательное удаление мягко удаленных аккаунтов.
+
+Удаление в запросе - один UPDATE deleted_at; здесь пачками по PURGE_BATCH_SIZE
+удаляются refresh-токены (тоже пачками - история бывает длинной), подписки,
+строки users и файлы аватаров, с паузой PURGE_THROTTLE_SECONDS между пачками.
+"""
+from datetime import datetime, timedelta
+from fastapi.concurrency import run_in_threadpool
+from pathlib import Path
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from typing import Optional
+import asyncio
+import time
+
+from config import (
+    PURGE_INTERVAL_SECONDS, PURGE_GRACE_SECONDS, PURGE_BATCH_SIZE,
+    PURGE_TOKEN_BATCH_SIZE, PURGE_THROTTLE_SECONDS
+)
+from database import open_session, shards
+from models import User, RefreshToken
+from compression import remove_with_sidecars
+from follows import remove_user_edges, friend_cache
+
+# Прогресс для логов и отладки: сколько удалено с запуска воркера
+purge_progress = {"users": 0, "tokens": 0, "avatars": 0, "batches": 0, "last_batch_at": None}
+
+def _avatar_path(avatar_url: str) -> Path:
+    return Path(avatar_url.replace("/uploads/", "uploads/"))
+
+def purge_batch(db: Session, batch_size: int = PURGE_BATCH_SIZE, grace_seconds: float = PURGE_GRACE_SECONDS) -> int:
+    """Удаляет одну пачку аккаунтов, удаленных раньше grace_seconds назад; возвращает их число"""
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    # SKIP LOCKED: воркеры не берут одну и ту же пачку (на SQLite игнорируется)
+    rows = db.execute(
+        select(User.id, User.avatar_url)
+        .where(User.deleted_at.isnot(None), User.deleted_at <= cutoff)
+        .order_by(User.deleted_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not rows:
+        db.rollback()
+        return 0
+    user_ids = [row.id for row in rows]
+
+    # Токены удаляются пачками, чтобы CASCADE при удалении users был пустым;
+    # при шардировании - отдельно на шарде каждой группы пользователей. Условие по
+    # user_id на верхнем уровне DELETE направляет запрос только на этот шард
+    # (id подзапроса ключом шарда не является) - rowcount сравнивается с лимитом одного шарда
+    tokens = 0
+    for shard_user_ids in shards.group(user_ids).values():
+        while True:
+            token_ids = select(RefreshToken.id).where(
+                RefreshToken.user_id.in_(shard_user_ids)
+            ).limit(PURGE_TOKEN_BATCH_SIZE).scalar_subquery()
+            deleted = db.execute(delete(RefreshToken).where(
+                RefreshToken.user_id.in_(shard_user_ids), RefreshToken.id.in_(token_ids)
+            )).rowcount
+            tokens += deleted
+            if deleted < PURGE_TOKEN_BATCH_SIZE:
+                break
+
+    remove_user_edges(db, *user_ids)
+    db.execute(delete(User).where(User.id.in_(user_ids)))
+    db.commit()
+    friend_cache.invalidate(*user_ids)
+
+    # Файлы - после коммита: откат транзакции не должен оставить аккаунт без аватара
+    avatars = 0
+    for row in rows:
+        if row.avatar_url:
+            remove_with_sidecars(_avatar_path(row.avatar_url))
+            avatars += 1
+
+    purge_progress["users"] += len(user_ids)
+    purge_progress["tokens"] += tokens
+    purge_progress["avatars"] += avatars
+    purge_progress["batches"] += 1
+    purge_progress["last_batch_at"] = datetime.utcnow().isoformat()
+    print(f"Очистка удаленных аккаунтов: пачка {len(user_ids)} польз., {tokens} токенов, {avatars} аватаров "
+          f"(всего {purge_progress['users']})")
+    return len(user_ids)
+
+def purge_deleted_users(max_batches: Optional[int] = None, throttle: float = PURGE_THROTTLE_SECONDS) -> int:
+    """Удаляет пачки, пока они есть (или max_batches); возвращает число удаленных аккаунтов"""
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        db = open_session()
+        try:
+            purged = purge_batch(db)
+        except Exception as e:
+            print(f"Ошибка очистки удаленных аккаунтов: {str(e)}")
+            db.rollback()
+            break
+        finally:
+            db.close()
+        if not purged:
+            break
+        total += purged
+        batches += 1
+        time.sleep(throttle)
+    return total
+
+async def _purge_loop() -> None:
+    while True:
+        # Одна пачка за вызов пула потоков - остановка воркера не ждет всю очередь
+        while await run_in_threadpool(purge_deleted_users, 1, 0):
+            await asyncio.sleep(PURGE_THROTTLE_SECONDS)
+        await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+
+_purge_task: Optional[asyncio.Task] = None
+
+def start_purger() -> None:
+    global _purge_task
+    if PURGE_INTERVAL_SECONDS > 0 and _purge_task is None:
+        _purge_task = asyncio.create_task(_purge_loop())
+
+async def stop_purger() -> None:
+    global _purge_task
+    if _purge_task is not None:
+        _purge_task.cancel()
+        try:
+            await _purge_task
+        except asyncio.CancelledError:
+            pass
+        _purge_task = None
+
+
+if __name__ == "__main__":
+    # Разовая очистка вручную: python purge.py
+    print(f"Удалено аккаунтов: {purge_deleted_users()}")
@@ -0,0 +1,219 @@
+"""Перенос пользователей на шарды по новой карте.
+
+    python reshard.py --to "s1=URL,s2=URL,s3=URL" [--dry-run] [--batch-size 500]
+    python reshard.py --prune-directory [--min-age 3600]
+
+Источник - текущая карта DATABASE_SHARD_URLS, а если шардирование еще не
+включено - основная БД DATABASE_URL (первый переход на шарды; тогда же
+заполняется каталог user_directory). Пачками по id пользователи, их
+refresh-токены и недоставленные события outbox копируются на шард-владелец
+по новой карте и удаляются с источника. Повторный запуск после сбоя безопасен:
+пользователи и токены вставляются с ON CONFLICT DO NOTHING, события outbox
+могут быть доставлены повторно.
+
+Запись в users на время переноса останавливается (режим обслуживания), после
+переноса воркеры перезапускаются с новым DATABASE_SHARD_URLS. Перенос не
+начинается, пока в общей БД есть внешние ключи на users (follows из
+scripts/update_database.sql): их ON DELETE CASCADE удалил бы связанные строки.
+
+--prune-directory снимает резервы каталога, для которых пользователь так и не
+появился на шарде (процесс упал между коммитом каталога и коммитом шарда).
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import delete, inspect, or_, select, text
+from sqlalchemy.engine import Engine
+from typing import Dict, List
+import argparse
+
+from config import SHARD_VIRTUAL_NODES, parse_shard_urls
+from database import Base, SHARD_KEYS, GLOBAL_SHARD, SessionLocal, ShardMap, get_engine, shards, user_data_engines
+from models import User, RefreshToken, OutboxEvent, UserDirectory
+from crud import get_dialect_insert, discard_user_id
+
+SHARDED_TABLES = [table for table in Base.metadata.sorted_tables if table.name in SHARD_KEYS]
+
+def global_foreign_keys() -> List[str]:
+    """Внешние ключи таблиц общей БД на таблицы шардов"""
+    inspector = inspect(get_engine())
+    found = []
+    for table in inspector.get_table_names():
+        if table in SHARD_KEYS:
+            continue
+        for foreign_key in inspector.get_foreign_keys(table):
+            if foreign_key["referred_table"] in SHARD_KEYS:
+                found.append(f"{table}.{foreign_key['name'] or ','.join(foreign_key['constrained_columns'])}")
+    return found
+
+def _insert_ignore(db, table, rows: List[dict]) -> None:
+    if rows:
+        db.execute(get_dialect_insert(db)(table).on_conflict_do_nothing(), rows)
+
+def backfill_directory(source: Engine, batch_size: int) -> int:
+    """Заполняет каталог из users источника: id и email/username живых аккаунтов"""
+    filled = 0
+    last_id = 0
+    src = SessionLocal(bind=source)
+    db = SessionLocal(bind=get_engine())
+    try:
+        while True:
+            rows = src.execute(
+                select(User.id, User.email_normalized, User.username_normalized, User.created_at, User.deleted_at)
+                .where(User.id > last_id).order_by(User.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            _insert_ignore(db, UserDirectory.__table__, [
+                {
+                    "id": row.id,
+                    "email_normalized": row.email_normalized if row.deleted_at is None else None,
+                    "username_normalized": row.username_normalized if row.deleted_at is None else None,
+                    "created_at": row.created_at,
+                }
+                for row in rows
+            ])
+            db.commit()
+            filled += len(rows)
+        if db.get_bind().dialect.name == "postgresql":
+            # Явные id не сдвигают последовательность - новые id должны идти после перенесенных
+            db.execute(text(
+                "SELECT setval(pg_get_serial_sequence('user_directory', 'id'), COALESCE(MAX(id), 1)) FROM user_directory"
+            ))
+            db.commit()
+    finally:
+        src.close()
+        db.close()
+    return filled
+
+def move_batch(source: Engine, target: Engine, user_ids: List[int]) -> None:
+    """Копирует пользователей с их токенами и событиями на target, затем удаляет с source"""
+    src = SessionLocal(bind=source)
+    dst = SessionLocal(bind=target)
+    try:
+        users = [dict(row) for row in src.execute(select(User.__table__).where(User.id.in_(user_ids))).mappings()]
+        # id токенов и событий у каждого шарда свои - на новом шарде выдаются заново
+        tokens = [
+            {key: value for key, value in row.items() if key != "id"}
+            for row in src.execute(select(RefreshToken.__table__).where(RefreshToken.user_id.in_(user_ids))).mappings()
+        ]
+        events = [
+            {key: value for key, value in row.items() if key != "id"}
+            for row in src.execute(select(OutboxEvent.__table__).where(
+                OutboxEvent.aggregate_id.in_(user_ids), OutboxEvent.dispatched_at.is_(None)
+            )).mappings()
+        ]
+        src.rollback()
+
+        _insert_ignore(dst, User.__table__, users)
+        _insert_ignore(dst, RefreshToken.__table__, tokens)
+        if events:
+            dst.execute(OutboxEvent.__table__.insert(), events)
+        dst.commit()
+
+        src.execute(delete(RefreshToken).where(RefreshToken.user_id.in_(user_ids)))
+        src.execute(delete(OutboxEvent).where(OutboxEvent.aggregate_id.in_(user_ids)))
+        src.execute(delete(User).where(User.id.in_(user_ids)))
+        src.commit()
+    finally:
+        src.close()
+        dst.close()
+
+def reshard(target_urls: Dict[str, str], batch_size: int = 500, dry_run: bool = False) -> Counter:
+    """Переносит пользователей, чей шард по новой карте изменился; возвращает число по направлениям"""
+    foreign_keys = global_foreign_keys()
+    if foreign_keys:
+        message = (f"Внешние ключи на таблицы шардов в общей БД: {', '.join(foreign_keys)}. "
+                   "Снимите их (scripts/update_database.sql) перед переносом")
+        if not dry_run:
+            raise RuntimeError(message)
+        print(message)
+    target_map = ShardMap(target_urls, SHARD_VIRTUAL_NODES)
+    sources = user_data_engines()
+    moved = Counter()
+
+    if not dry_run:
+        for engine in target_map.engines().values():
+            Base.metadata.create_all(bind=engine, tables=SHARDED_TABLES)
+        if GLOBAL_SHARD in sources:
+            Base.metadata.create_all(bind=get_engine(), tables=[UserDirectory.__table__])
+            print(f"Каталог: {backfill_directory(sources[GLOBAL_SHARD], batch_size)} пользователей")
+
+    for source_name, source in sources.items():
+        last_id = 0
+        while True:
+            db = SessionLocal(bind=source)
+            try:
+                user_ids = list(db.execute(
+                    select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+                ).scalars())
+            finally:
+                db.close()
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+
+            for target_name, ids in target_map.group(user_ids).items():
+                if target_name == source_name:
+                    continue
+                if not dry_run:
+                    move_batch(source, target_map.engine(target_name), ids)
+                moved[source_name, target_name] += len(ids)
+        print(f"{source_name}: обработан до id {last_id}")
+
+    target_map.dispose()
+    return moved
+
+def prune_directory(min_age_seconds: float, batch_size: int = 500) -> int:
+    """Снимает резервы email/username старше min_age_seconds без пользователя на шарде"""
+    if not shards.enabled:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age_seconds)
+    pruned = 0
+    last_id = 0
+    while True:
+        db = SessionLocal(bind=get_engine())
+        try:
+            # Удаленные аккаунты освобождают имена (NULL) - их строки не трогаем
+            user_ids = list(db.execute(
+                select(UserDirectory.id)
+                .where(
+                    UserDirectory.id > last_id, UserDirectory.created_at < cutoff,
+                    or_(UserDirectory.email_normalized.isnot(None), UserDirectory.username_normalized.isnot(None))
+                )
+                .order_by(UserDirectory.id).limit(batch_size)
+            ).scalars())
+        finally:
+            db.close()
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+        for shard_name, ids in shards.group(user_ids).items():
+            with shards.engine(shard_name).connect() as conn:
+                existing = set(conn.execute(select(User.id).where(User.id.in_(ids))).scalars())
+            pruned += sum(discard_user_id(user_id) for user_id in ids if user_id not in existing)
+    return pruned
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос пользователей на шарды по новой карте")
+    parser.add_argument("--to", help='новая карта шардов: "s1=URL,s2=URL"')
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, сколько пользователей переедет")
+    parser.add_argument("--prune-directory", action="store_true", help="снять резервы каталога без пользователя")
+    parser.add_argument("--min-age", type=float, default=3600, help="возраст резерва для --prune-directory, секунды")
+    args = parser.parse_args()
+
+    if args.prune_directory:
+        print(f"Снято резервов каталога: {prune_directory(args.min_age, args.batch_size)}")
+        raise SystemExit(0)
+    if not args.to:
+        parser.error("нужен --to или --prune-directory")
+
+    try:
+        moved = reshard(parse_shard_urls(args.to), args.batch_size, args.dry_run)
+    except RuntimeError as e:
+        parser.exit(1, f"{str(e)}\n")
+    for (source_name, target_name), count in sorted(moved.items()):
+        print(f"{source_name} -> {target_name}: {count}")
+    print(f"Всего {'переедет' if args.dry_run else 'перенесено'}: {sum(moved.values())}")
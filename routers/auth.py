@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Response, Cookie
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Cookie, Header
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
-from main import (
-    get_db, authenticate_user, create_access_token, create_refresh_token,
-    verify_token, get_user_by_id, LoginRequest, TokenResponse, User, RefreshToken
+from database import get_db
+from models import User, LIVE_USER, RefreshToken, ME_COLUMNS
+from schemas import LoginRequest, TokenResponse, IntrospectRequest
+from security import (
+    authenticate_user, create_access_token, create_refresh_token, verify_token, verify_tokens_cached
 )
+from crud import get_user_by_id, user_exists
+from config import INTROSPECT_MAX_TOKENS, INTROSPECT_CLIENT_TOKEN
 from typing import Optional
+import hmac
 
 router = APIRouter()
 
@@ -17,7 +24,7 @@ async def login(
 ):
     print(f"Попытка входа для пользователя: {login_data.username}")
     
-    user = authenticate_user(db, login_data.username, login_data.password)
+    user = await authenticate_user(db, login_data.username, login_data.password)
     if not user:
         print(f"Неверные учетные данные для: {login_data.username}")
         raise HTTPException(
@@ -94,8 +101,7 @@ async def get_current_token(
                 detail="Invalid token"
             )
         
-        user = get_user_by_id(db, int(user_id))
-        if not user:
+        if not user_exists(db, User.id == int(user_id)):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="User not found"
@@ -127,16 +133,18 @@ async def refresh_token(
     # Verify refresh token
     try:
         payload = verify_token(refresh_token, "refresh")
-        user_id = payload.get("sub")
-    except HTTPException:
+        user_id = int(payload.get("sub"))
+    except (HTTPException, TypeError, ValueError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid refresh token"
         )
     
     # Check if refresh token exists in database and is active
+    # (условие на user_id направляет запрос на шард пользователя)
     db_refresh_token = db.query(RefreshToken).filter(
         RefreshToken.token == refresh_token,
+        RefreshToken.user_id == user_id,
         RefreshToken.is_active == True
     ).first()
     
@@ -146,17 +154,16 @@ async def refresh_token(
             detail="Refresh token expired or invalid"
         )
     
-    # Get user
-    user = get_user_by_id(db, int(user_id))
-    if not user:
+    # Check user exists
+    if not user_exists(db, User.id == user_id):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
     
     # Create new tokens
-    new_access_token = create_access_token(data={"sub": str(user.id)})
-    new_refresh_token = create_refresh_token(data={"sub": str(user.id)})
+    new_access_token = create_access_token(data={"sub": str(user_id)})
+    new_refresh_token = create_refresh_token(data={"sub": str(user_id)})
     
     # Deactivate old refresh token
     db_refresh_token.is_active = False
@@ -164,7 +171,7 @@ async def refresh_token(
     # Create new refresh token record
     new_db_refresh_token = RefreshToken(
         token=new_refresh_token,
-        user_id=user.id,
+        user_id=user_id,
         expires_at=datetime.utcnow() + timedelta(days=7)
     )
     db.add(new_db_refresh_token)
@@ -233,7 +240,7 @@ async def get_current_user_info(
                 detail="Invalid token"
             )
         
-        user = get_user_by_id(db, int(user_id))
+        user = get_user_by_id(db, int(user_id), *ME_COLUMNS)
         
         if not user:
             raise HTTPException(
@@ -261,3 +268,59 @@ async def get_current_user_info(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Authentication error"
         )
+
+@router.post("/introspect")
+async def introspect_tokens(
+    request: IntrospectRequest,
+    x_introspect_token: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Проверка пачки access-токенов для шлюзов: {"results": [{"active": ..., ...}]} в порядке запроса.
+
+    Только для сервисов с X-Introspect-Token; без INTROSPECT_CLIENT_TOKEN эндпоинт выключен (404)
+    """
+    if not INTROSPECT_CLIENT_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not Found"
+        )
+    if not x_introspect_token or not hmac.compare_digest(x_introspect_token, INTROSPECT_CLIENT_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    if len(request.tokens) > INTROSPECT_MAX_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many tokens, maximum is {INTROSPECT_MAX_TOKENS}"
+        )
+    
+    # Подписи - из кеша проверенных токенов, пользователи - одним запросом IN
+    payloads = verify_tokens_cached(request.tokens)
+    user_ids = set()
+    for payload in payloads.values():
+        if payload is not None and str(payload["sub"]).isdigit():
+            user_ids.add(int(payload["sub"]))
+    users = {}
+    if user_ids:
+        users = {
+            row.id: row for row in db.execute(
+                select(User.id, User.username, User.is_active).where(User.id.in_(user_ids), LIVE_USER)
+            )
+        }
+    
+    results = []
+    for token in request.tokens:
+        payload = payloads[token]
+        user = users.get(int(payload["sub"])) if payload is not None and str(payload["sub"]).isdigit() else None
+        if user is None or not user.is_active:
+            results.append({"active": False})
+            continue
+        results.append({
+            "active": True,
+            "sub": str(user.id),
+            "username": user.username,
+            "token_type": payload["type"],
+            "exp": payload["exp"],
+        })
+    return ORJSONResponse({"results": results})
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from typing import List
+from database import get_db
+from models import User, LIVE_USER
+from schemas import UserPublicProfile
+from security import get_current_user
+from crud import user_exists, fetch_user_page, get_profile_projection, project_user_profiles
+from follows import follow, unfollow, friend_ids_filter, friend_cache
+
+router = APIRouter()
+
+@router.post("/{user_id}")
+async def follow_user(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Подписаться на пользователя; взаимная подписка - дружба"""
+    if user_id == current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cannot follow yourself"
+        )
+    
+    if not user_exists(db, User.id == user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    
+    created = follow(db, current_user.id, user_id)
+    db.commit()
+    # После коммита: иначе параллельное чтение может закешировать старое состояние
+    friend_cache.invalidate(current_user.id, user_id)
+    
+    return {"following": True, "created": created}
+
+@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def unfollow_user(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Отписаться от пользователя"""
+    if not unfollow(db, current_user.id, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not following this user"
+        )
+    db.commit()
+    friend_cache.invalidate(current_user.id, user_id)
+    
+    return None
+
+@router.get("/", response_model=List[UserPublicProfile])
+async def get_my_friends(
+    skip: int = 0,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Друзья текущего пользователя (взаимные подписки)"""
+    projection = get_profile_projection("friends", is_friend=True)
+    query = select(*projection.columns, User.profile_visibility).where(
+        LIVE_USER, User.id.in_(friend_ids_filter(db, current_user.id))
+    ).order_by(User.id)
+    
+    users = fetch_user_page(db, query, skip, limit)
+    # Все строки - друзья: "friends" и "public" видны полностью, "private" - как приватный
+    friend_ids = {user["id"] for user in users}
+    
+    return ORJSONResponse(project_user_profiles(users, current_user.id, friend_ids=friend_ids))
@@ -0,0 +1,147 @@
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import text
+from datetime import datetime
+from typing import Optional
+import asyncio
+import hmac
+import time
+import uuid
+
+from config import HEALTH_CACHE_SECONDS, HEALTH_PROBE_TIMEOUT, HEALTH_ADMIN_TOKEN
+from database import get_engine, replicas, shards, open_session
+from security import hash_pool_status
+from routers.profile import UPLOAD_DIR
+from lifecycle import is_draining, set_draining, request_stats
+from outbox import outbox_metrics
+
+router = APIRouter()
+
+_ready_cache: Optional[dict] = None
+_ready_cached_at = 0.0
+_ready_lock = asyncio.Lock()
+
+def check_database() -> dict:
+    engine = get_engine()
+    pool = engine.pool
+    checked_out = pool.checkedout() if hasattr(pool, "checkedout") else 0
+    capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0) if hasattr(pool, "size") else None
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    available = capacity - checked_out if capacity is not None else None
+    return {
+        "ok": available is None or available > 0,
+        "checked_out": checked_out,
+        "capacity": capacity,
+    }
+
+def check_replicas() -> dict:
+    # Отставшая реплика не делает воркер неготовым - чтения уходят в основную БД
+    usable = [url for url in replicas.urls if replicas.is_usable(url)]
+    return {"ok": True, "usable": len(usable), "total": len(replicas.urls), "replicas": replicas.status()}
+
+def check_shards() -> dict:
+    # Без любого шарда часть пользователей недоступна - воркер не готов
+    failed = []
+    for name, engine in shards.engines().items():
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except Exception as e:
+            failed.append({"shard": name, "error": str(e)})
+    return {"ok": not failed, "total": len(shards.names), "failed": failed}
+
+def check_storage() -> dict:
+    probe = UPLOAD_DIR / f".health-{uuid.uuid4().hex}"
+    probe.write_bytes(b"ok")
+    probe.unlink()
+    return {"ok": True}
+
+async def _probe(func) -> dict:
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(run_in_threadpool(func), timeout=HEALTH_PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        result = {"ok": False, "error": "timeout"}
+    except Exception as e:
+        result = {"ok": False, "error": str(e)}
+    result["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+async def _run_ready_checks() -> dict:
+    names = ("database", "replicas", "shards", "storage")
+    results = await asyncio.gather(
+        _probe(check_database),
+        _probe(check_replicas),
+        _probe(check_shards),
+        _probe(check_storage),
+    )
+    checks = dict(zip(names, results))
+    hash_pool = hash_pool_status()
+    checks["hash_pool"] = {"ok": not hash_pool["saturated"], **hash_pool}
+    return {
+        "status": "ready" if all(check["ok"] for check in checks.values()) else "not_ready",
+        "checks": checks,
+        "checked_at": datetime.utcnow().isoformat(),
+    }
+
+@router.get("/live")
+async def liveness():
+    """Процесс жив и обслуживает event loop (без обращений к зависимостям)"""
+    return {"status": "alive", "timestamp": datetime.utcnow().isoformat()}
+
+@router.get("")
+async def health_check():
+    """Совместимость со старыми проверками: то же, что /health/live"""
+    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+
+@router.get("/ready")
+async def readiness():
+    """Готовность принимать трафик; результат проверок кешируется на HEALTH_CACHE_SECONDS"""
+    global _ready_cache, _ready_cached_at
+    
+    # В дренаже балансировщик должен перестать слать трафик - зависимости не проверяем
+    if is_draining():
+        return ORJSONResponse(
+            {"status": "draining", "requests": request_stats()},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    
+    if _ready_cache is None or time.monotonic() - _ready_cached_at > HEALTH_CACHE_SECONDS:
+        # Одновременные пробы ждут одну проверку, а не запускают свои
+        async with _ready_lock:
+            if _ready_cache is None or time.monotonic() - _ready_cached_at > HEALTH_CACHE_SECONDS:
+                _ready_cache = await _run_ready_checks()
+                _ready_cached_at = time.monotonic()
+    
+    status_code = status.HTTP_200_OK if _ready_cache["status"] == "ready" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return ORJSONResponse(_ready_cache, status_code=status_code)
+
+def require_admin_token(x_admin_token: Optional[str]) -> None:
+    """Служебные эндпоинты health - только с X-Admin-Token = HEALTH_ADMIN_TOKEN; без токена в конфиге закрыты"""
+    if not HEALTH_ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, HEALTH_ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+def _outbox_metrics() -> dict:
+    db = open_session()
+    try:
+        return outbox_metrics(db)
+    finally:
+        db.close()
+
+@router.get("/outbox")
+async def outbox_lag(x_admin_token: Optional[str] = Header(None)):
+    """Отставание доставки событий outbox (на readiness не влияет); требует X-Admin-Token"""
+    require_admin_token(x_admin_token)
+    return await _probe(lambda: {"ok": True, **_outbox_metrics()})
+
+@router.post("/drain")
+async def drain(enabled: bool = True, x_admin_token: Optional[str] = Header(None)):
+    """Включить (или выключить, ?enabled=false) режим дренажа"""
+    require_admin_token(x_admin_token)
+    set_draining(enabled)
+    return {"draining": enabled}
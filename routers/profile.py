@@ -1,12 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select, or_, and_, text
 from sqlalchemy.orm import Session
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
 from typing import List, Optional
-from main import (
-    get_db, get_current_user, get_user_by_id, filter_user_profile,
-    User, UserProfileUpdate, UserPrivacySettings, UserResponse, UserPublicProfile
+from config import STATS_REFRESH_SECONDS
+from database import get_db, open_session
+from models import User, LIVE_USER, ProfileStats, PUBLIC_PROFILE_COLUMNS, PROFILE_COMPLETENESS_FIELDS
+from schemas import UserProfileUpdate, UserPrivacySettings, UserResponse, UserPublicProfile
+from security import get_current_user, get_current_user_profile
+from compression import write_precompressed_sidecars, remove_with_sidecars
+from crud import (
+    fetch_user_dicts, fetch_user_page, project_user_profile, project_user_profiles,
+    get_profile_projection, set_profile_field, normalize_identity, touch_profile,
+    profile_etag, etag_matches, diff_user_fields, update_user_fields
 )
-import os
+from follows import friends_among, friend_ids_filter
+from outbox import record_event
+import asyncio
 import uuid
 from pathlib import Path
 
@@ -14,45 +27,159 @@ router = APIRouter()
 
 # Конфигурация для загрузки файлов
 UPLOAD_DIR = Path("uploads/avatars")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
 
+SIGNUPS_WINDOW_DAYS = 30
+# Ключ advisory-блокировки пересчета: снапшот пересчитывает один воркер за период
+STATS_REFRESH_LOCK_KEY = 0x70726f66
+
+def _acquire_refresh_lock(db: Session) -> bool:
+    """Блокировка до конца транзакции; False - пересчет уже идет в другом воркере"""
+    if db.get_bind().dialect.name != "postgresql":
+        return True
+    return bool(db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": STATS_REFRESH_LOCK_KEY}).scalar())
+
+def refresh_profile_stats(db: Session) -> bool:
+    """Пересчитывает таблицу profile_stats: распределение заполненности и регистрации по дням.
+    Возвращает False, если пересчет пропущен - его уже выполняет другой воркер"""
+    # Блокировка берется до сканирования: остальные воркеры не повторяют агрегаты
+    # и не сталкиваются на первичном ключе (metric, bucket) при замене снапшота
+    if not _acquire_refresh_lock(db):
+        db.rollback()
+        return False
+    now = datetime.utcnow()
+    # При шардировании каждый запрос возвращает строки всех шардов - счетчики суммируются
+    totals = Counter()
+    totals["total_users", "all"] = sum(count for (count,) in db.query(func.count(User.id)).filter(LIVE_USER))
+    
+    completeness = db.query(User.profile_completeness, func.count(User.id)).filter(LIVE_USER).group_by(
+        User.profile_completeness
+    )
+    for bucket, count in completeness:
+        totals["completeness", str(bucket)] += count
+    
+    signup_day = func.date(User.created_at)
+    signups = db.query(signup_day, func.count(User.id)).filter(
+        LIVE_USER, User.created_at >= now - timedelta(days=SIGNUPS_WINDOW_DAYS)
+    ).group_by(signup_day)
+    for day, count in signups:
+        totals["signups_per_day", str(day)] += count
+    rows = [(metric, bucket, value) for (metric, bucket), value in totals.items()]
+    
+    # Полная замена снапшота в одной транзакции - читатели видят старый или новый целиком
+    db.query(ProfileStats).delete(synchronize_session=False)
+    db.add_all([
+        ProfileStats(metric=metric, bucket=bucket, value=value, refreshed_at=now)
+        for metric, bucket, value in rows
+    ])
+    db.commit()
+    return True
+
+def prepare_upload_dir() -> None:
+    """Создает каталог для аватаров (вызывается при старте приложения, не при импорте)"""
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+def _refresh_profile_stats_once() -> None:
+    db = open_session()
+    try:
+        refresh_profile_stats(db)
+    except Exception as e:
+        print(f"Ошибка пересчета статистики профилей: {str(e)}")
+        db.rollback()
+    finally:
+        db.close()
+
+async def _profile_stats_loop() -> None:
+    while True:
+        await run_in_threadpool(_refresh_profile_stats_once)
+        await asyncio.sleep(STATS_REFRESH_SECONDS)
+
+_stats_task: Optional[asyncio.Task] = None
+
+def start_profile_stats_refresh() -> None:
+    global _stats_task
+    if STATS_REFRESH_SECONDS > 0 and _stats_task is None:
+        _stats_task = asyncio.create_task(_profile_stats_loop())
+
+async def stop_profile_stats_refresh() -> None:
+    global _stats_task
+    if _stats_task is not None:
+        _stats_task.cancel()
+        try:
+            await _stats_task
+        except asyncio.CancelledError:
+            pass
+        _stats_task = None
+
+def write_profile_changes(db: Session, current_user: User, update_data: dict, if_match: Optional[str]):
+    """Общая часть PUT профиля: If-Match, пропуск записи без изменений, UPDATE ... RETURNING"""
+    # If-Match сверяется с загруженной версией - клиент редактировал устаревшие данные
+    if if_match is not None and not etag_matches(if_match, current_user.version):
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Profile was modified by another request"
+        )
+    
+    changes = diff_user_fields(current_user, update_data)
+    if not changes:
+        # Ничего не изменилось - ни записи, ни новой версии, ETag прежний
+        return None
+    
+    user = update_user_fields(db, current_user, changes)
+    if user is None:
+        # Версию изменил параллельный запрос между чтением и записью
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Profile was modified by another request"
+        )
+    record_event(db, "user.updated", current_user.id, {"fields": sorted(changes), "version": user["version"]})
+    db.commit()
+    
+    version = user.pop("version")
+    return ORJSONResponse(user, headers={"ETag": profile_etag(version)})
+
 @router.get("/me", response_model=UserResponse)
 async def get_my_profile(
-    current_user: User = Depends(get_current_user),
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user_profile),
     db: Session = Depends(get_db)
 ):
     """Получить свой полный профиль"""
+    etag = profile_etag(current_user.version)
+    if if_none_match is not None and etag_matches(if_none_match, current_user.version):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    response.headers["ETag"] = etag
     return current_user
 
 @router.put("/me", response_model=UserResponse)
 async def update_my_profile(
     profile_data: UserProfileUpdate,
-    current_user: User = Depends(get_current_user),
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user_profile),
     db: Session = Depends(get_db)
 ):
-    """Обновить свой профиль"""
+    """Обновить свой профиль (If-Match: ETag из GET /profile/me защищает от перезаписи)"""
     
-    # Обновляем поля профиля
     update_data = profile_data.dict(exclude_unset=True)
     
-    for field, value in update_data.items():
-        if hasattr(current_user, field):
-            setattr(current_user, field, value)
-    
-    # Обновляем время изменения профиля
-    current_user.profile_updated_at = datetime.utcnow()
-    
-    db.commit()
-    db.refresh(current_user)
+    updated = write_profile_changes(db, current_user, update_data, if_match)
+    if updated is not None:
+        return updated
     
+    response.headers["ETag"] = profile_etag(current_user.version)
     return current_user
 
 @router.put("/me/privacy", response_model=UserResponse)
 async def update_privacy_settings(
     privacy_data: UserPrivacySettings,
-    current_user: User = Depends(get_current_user),
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user_profile),
     db: Session = Depends(get_db)
 ):
     """Обновить настройки приватности"""
@@ -67,15 +194,11 @@ async def update_privacy_settings(
                 detail="Invalid profile visibility value"
             )
     
-    for field, value in update_data.items():
-        if hasattr(current_user, field):
-            setattr(current_user, field, value)
-    
-    current_user.profile_updated_at = datetime.utcnow()
-    
-    db.commit()
-    db.refresh(current_user)
+    updated = write_profile_changes(db, current_user, update_data, if_match)
+    if updated is not None:
+        return updated
     
+    response.headers["ETag"] = profile_etag(current_user.version)
     return current_user
 
 @router.post("/me/avatar")
@@ -106,11 +229,12 @@ async def upload_avatar(
     filename = f"{file_id}{file_extension}"
     file_path = UPLOAD_DIR / filename
     
-    # Сохраняем файл
+    # Сохраняем файл (и предсжатые копии для nginx, если они имеют смысл)
     try:
+        content = await file.read()
         with open(file_path, "wb") as buffer:
-            content = await file.read()
             buffer.write(content)
+        await run_in_threadpool(write_precompressed_sidecars, file_path, content)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -120,12 +244,12 @@ async def upload_avatar(
     # Удаляем старый аватар если есть
     if current_user.avatar_url:
         old_file_path = Path(current_user.avatar_url.replace("/uploads/", "uploads/"))
-        if old_file_path.exists():
-            old_file_path.unlink()
+        remove_with_sidecars(old_file_path)
     
     # Обновляем URL аватара в базе данных
-    current_user.avatar_url = f"/uploads/avatars/{filename}"
-    current_user.profile_updated_at = datetime.utcnow()
+    set_profile_field(current_user, "avatar_url", f"/uploads/avatars/{filename}")
+    touch_profile(current_user)
+    record_event(db, "user.avatar_changed", current_user.id, {"avatar_url": current_user.avatar_url})
     
     db.commit()
     
@@ -149,17 +273,23 @@ async def delete_avatar(
     
     # Удаляем файл
     file_path = Path(current_user.avatar_url.replace("/uploads/", "uploads/"))
-    if file_path.exists():
-        file_path.unlink()
+    remove_with_sidecars(file_path)
     
     # Обновляем базу данных
-    current_user.avatar_url = None
-    current_user.profile_updated_at = datetime.utcnow()
+    set_profile_field(current_user, "avatar_url", None)
+    touch_profile(current_user)
+    record_event(db, "user.avatar_changed", current_user.id, {"avatar_url": None})
     
     db.commit()
     
     return {"message": "Avatar deleted successfully"}
 
+def profile_friend_ids(db: Session, row: dict, viewer_id: int):
+    """Друг ли зритель владельцу профиля; запрос нужен только для видимости friends"""
+    if row["profile_visibility"] != "friends" or row["id"] == viewer_id:
+        return frozenset()
+    return friends_among(db, viewer_id, (row["id"],))
+
 @router.get("/{user_id}", response_model=UserPublicProfile)
 async def get_user_profile(
     user_id: int,
@@ -168,14 +298,14 @@ async def get_user_profile(
 ):
     """Получить публичный профиль пользователя"""
     
-    user = get_user_by_id(db, user_id)
-    if not user:
+    users = fetch_user_dicts(db, select(*PUBLIC_PROFILE_COLUMNS).where(User.id == user_id, LIVE_USER))
+    if not users:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    return filter_user_profile(user, current_user)
+    return ORJSONResponse(project_user_profile(users[0], current_user.id, profile_friend_ids(db, users[0], current_user.id)))
 
 @router.get("/username/{username}", response_model=UserPublicProfile)
 async def get_user_profile_by_username(
@@ -185,15 +315,16 @@ async def get_user_profile_by_username(
 ):
     """Получить публичный профиль пользователя по username"""
     
-    from main import get_user_by_username
-    user = get_user_by_username(db, username)
-    if not user:
+    users = fetch_user_dicts(db, select(*PUBLIC_PROFILE_COLUMNS).where(
+        User.username_normalized == normalize_identity(username), LIVE_USER
+    ))
+    if not users:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    return filter_user_profile(user, current_user)
+    return ORJSONResponse(project_user_profile(users[0], current_user.id, profile_friend_ids(db, users[0], current_user.id)))
 
 @router.get("/", response_model=List[UserPublicProfile])
 async def search_users(
@@ -205,23 +336,30 @@ async def search_users(
 ):
     """Поиск пользователей"""
     
-    query = db.query(User).filter(User.is_active == True)
+    # В поиск попадают публичные профили и профили "только для друзей" друзей зрителя;
+    # колонки их проекций совпадают, а дружба проверяется подзапросом в том же SELECT
+    projection = get_profile_projection("public")
+    query = select(*projection.columns, User.profile_visibility).where(LIVE_USER, User.is_active == True)
     
     if q:
         search_term = f"%{q}%"
-        query = query.filter(
+        query = query.where(
             (User.username.ilike(search_term)) |
             (User.first_name.ilike(search_term)) |
             (User.last_name.ilike(search_term)) |
             (User.company.ilike(search_term))
         )
     
-    # Показываем только публичные профили в поиске
-    query = query.filter(User.profile_visibility == "public")
+    query = query.where(or_(
+        User.profile_visibility == "public",
+        and_(User.profile_visibility == "friends", User.id.in_(friend_ids_filter(db, current_user.id)))
+    ))
     
-    users = query.offset(skip).limit(limit).all()
+    users = fetch_user_page(db, query, skip, limit)
+    # Строки "friends" уже отфильтрованы до друзей зрителя
+    friend_ids = {user["id"] for user in users if user["profile_visibility"] == "friends"}
     
-    return [filter_user_profile(user, current_user) for user in users]
+    return ORJSONResponse(project_user_profiles(users, current_user.id, friend_ids=friend_ids))
 
 @router.get("/stats/me")
 async def get_my_stats(
@@ -230,21 +368,11 @@ async def get_my_stats(
 ):
     """Получить статистику своего профиля"""
     
-    # Подсчитываем различные метрики
-    profile_completeness = 0
-    total_fields = 10
-    
-    fields_to_check = [
-        'first_name', 'last_name', 'phone', 'birth_date', 
-        'bio', 'location', 'website', 'company', 'job_title', 'avatar_url'
-    ]
-    
-    for field in fields_to_check:
-        if getattr(current_user, field):
-            profile_completeness += 1
+    # Заполненность хранится в строке и поддерживается при записи профиля
+    profile_completeness = current_user.profile_completeness or 0
+    total_fields = len(PROFILE_COMPLETENESS_FIELDS)
     
     completeness_percentage = (profile_completeness / total_fields) * 100
-    
     # Время с момента регистрации
     days_since_registration = (datetime.utcnow() - current_user.created_at).days
     
@@ -267,3 +395,28 @@ async def get_my_stats(
             "show_birth_date": current_user.show_birth_date
         }
     }
+
+@router.get("/stats/overview")
+async def get_stats_overview(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Агрегированная статистика по пользователям (из материализованной таблицы)"""
+    
+    overview = {
+        "refreshed_at": None,
+        "total_users": 0,
+        "completeness_distribution": {},
+        "signups_per_day": {},
+    }
+    
+    for row in db.query(ProfileStats).all():
+        overview["refreshed_at"] = row.refreshed_at
+        if row.metric == "total_users":
+            overview["total_users"] = row.value
+        elif row.metric == "completeness":
+            overview["completeness_distribution"][row.bucket] = row.value
+        elif row.metric == "signups_per_day":
+            overview["signups_per_day"][row.bucket] = row.value
+    
+    return overview
@@ -1,10 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from typing import List
-from main import (
-    get_db, get_current_user, get_password_hash, get_user_by_username,
-    get_user_by_email, get_user_by_id, User, UserCreate, UserResponse, UserUpdate
+from database import get_db
+from models import User, LIVE_USER
+from schemas import UserCreate, UserResponse, UserUpdate
+from security import get_current_user_profile, get_current_user, get_password_hash_async
+from crud import (
+    user_exists, insert_user, count_completed_fields, select_user_response, fetch_user_dicts,
+    fetch_user_page, normalize_identity, identity_values, touch_profile, reserve_identity, release_identity,
+    discard_user_id
 )
+from follows import friend_cache
+from outbox import record_event
 from datetime import datetime
 
 router = APIRouter()
@@ -14,49 +22,60 @@ router = APIRouter()
 async def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
     print(f"🔍 Получен запрос на регистрацию: {user_data.username}, {user_data.email}")
     
-    # Проверяем, существует ли пользователь с таким username или email
-    existing_user_by_username = get_user_by_username(db, user_data.username)
-    if existing_user_by_username:
-        print(f"Пользователь с username {user_data.username} уже существует")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already registered"
-        )
-    
-    existing_user_by_email = get_user_by_email(db, user_data.email)
-    if existing_user_by_email:
-        print(f"Пользователь с email {user_data.email} уже существует")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
-        )
+    # Хешируем до вставки: регистрация - один INSERT ... ON CONFLICT DO NOTHING RETURNING
+    hashed_password = await get_password_hash_async(user_data.password)
     
+    created_user = None
     try:
         # Создаем нового пользователя с профильными полями
-        hashed_password = get_password_hash(user_data.password)
-        db_user = User(
-            email=user_data.email,
-            username=user_data.username,
-            hashed_password=hashed_password,
-            first_name=user_data.first_name,
-            last_name=user_data.last_name,
-            profile_visibility="public",
-            show_email=False,
-            show_phone=False,
-            show_birth_date=False,
-            profile_updated_at=datetime.utcnow()
-        )
+        values = {
+            **identity_values(email=user_data.email, username=user_data.username),
+            "hashed_password": hashed_password,
+            "first_name": user_data.first_name,
+            "last_name": user_data.last_name,
+            "profile_visibility": "public",
+            "show_email": False,
+            "show_phone": False,
+            "show_birth_date": False,
+            "profile_updated_at": datetime.utcnow()
+        }
+        values["profile_completeness"] = count_completed_fields(values)
+        created_user = insert_user(db, values)
+        
+        if created_user is None:
+            # Конфликт уникальности - выясняем, какое поле занято (редкий путь)
+            db.rollback()
+            if user_exists(db, User.username_normalized == normalize_identity(user_data.username)):
+                print(f"Пользователь с username {user_data.username} уже существует")
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Username already registered"
+                )
+            print(f"Пользователь с email {user_data.email} уже существует")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered"
+            )
         
-        db.add(db_user)
+        # Событие фиксируется тем же коммитом, что и сам аккаунт
+        record_event(db, "user.registered", created_user["id"], {"username": created_user["username"]})
         db.commit()
-        db.refresh(db_user)
         
-        print(f"Пользователь {user_data.username} успешно создан с ID: {db_user.id}")
-        return db_user
+        print(f"Пользователь {user_data.username} успешно создан с ID: {created_user['id']}")
+        return ORJSONResponse(created_user, status_code=status.HTTP_201_CREATED)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Ошибка при создании пользователя: {str(e)}")
         db.rollback()
+        if created_user is not None:
+            # При шардировании каталог уже зафиксирован - снимаем резерв, если аккаунт не записан
+            try:
+                discard_user_id(created_user["id"])
+            except Exception as cleanup_error:
+                # Резерв останется до reshard.py --prune-directory
+                print(f"Не удалось снять резерв каталога {created_user['id']}: {str(cleanup_error)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to create user"
@@ -70,8 +89,9 @@ async def get_users(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    users = db.query(User).offset(skip).limit(limit).all()
-    return users
+    # Строки уже типизированы БД - отдаем их напрямую в orjson, минуя pydantic
+    users = fetch_user_page(db, select_user_response(), skip, limit)
+    return ORJSONResponse(users)
 
 # READ - Получить пользователя по ID
 @router.get("/{user_id}", response_model=UserResponse)
@@ -80,13 +100,13 @@ async def get_user(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    user = get_user_by_id(db, user_id)
-    if not user:
+    users = fetch_user_dicts(db, select_user_response().where(User.id == user_id))
+    if not users:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
-    return user
+    return ORJSONResponse(users[0])
 
 # UPDATE - Обновить данные пользователя
 @router.put("/{user_id}", response_model=UserResponse)
@@ -94,7 +114,7 @@ async def update_user(
     user_id: int,
     user_update: UserUpdate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user_profile)
 ):
     print(f"Запрос на обновление пользователя {user_id} от пользователя {current_user.id}")
     
@@ -106,13 +126,8 @@ async def update_user(
             detail="Not enough permissions"
         )
     
-    user = get_user_by_id(db, user_id)
-    if not user:
-        print(f"Пользователь с ID {user_id} не найден")
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
+    # current_user уже загружен тем же запросом - повторный SELECT не нужен
+    user = current_user
     
     try:
         # Обновляем поля, если они предоставлены
@@ -121,33 +136,40 @@ async def update_user(
         
         if "email" in update_data:
             # Проверяем, не занят ли новый email
-            existing_user = get_user_by_email(db, update_data["email"])
-            if existing_user and existing_user.id != user_id:
+            if (
+                user_exists(db, User.email_normalized == normalize_identity(update_data["email"]), User.id != user_id)
+                or not reserve_identity(db, user_id, email=update_data["email"])
+            ):
                 print(f"Email {update_data['email']} уже занят")
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Email already registered"
                 )
-            user.email = update_data["email"]
+            for field, value in identity_values(email=update_data["email"]).items():
+                setattr(user, field, value)
             print(f"Email обновлен на: {update_data['email']}")
         
         if "username" in update_data:
             # Проверяем, не занят ли новый username
-            existing_user = get_user_by_username(db, update_data["username"])
-            if existing_user and existing_user.id != user_id:
+            if (
+                user_exists(db, User.username_normalized == normalize_identity(update_data["username"]), User.id != user_id)
+                or not reserve_identity(db, user_id, username=update_data["username"])
+            ):
                 print(f"Username {update_data['username']} уже занят")
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Username already registered"
                 )
-            user.username = update_data["username"]
+            for field, value in identity_values(username=update_data["username"]).items():
+                setattr(user, field, value)
             print(f"Username обновлен на: {update_data['username']}")
         
         if "password" in update_data:
-            user.hashed_password = get_password_hash(update_data["password"])
+            user.hashed_password = await get_password_hash_async(update_data["password"])
             print("Пароль обновлен")
         
-        user.profile_updated_at = datetime.utcnow()
+        touch_profile(user)
+        record_event(db, "user.updated", user_id, {"fields": sorted(update_data)})
         
         db.commit()
         db.refresh(user)
@@ -179,20 +201,19 @@ async def delete_user(
             detail="Not enough permissions"
         )
     
-    user = get_user_by_id(db, user_id)
-    if not user:
+    # Мягкое удаление - один UPDATE: аккаунт и его токены перестают действовать сразу
+    # (все чтения фильтруют LIVE_USER), а строки, токены и аватар удаляет purge.py
+    deleted = db.query(User).filter(User.id == user_id, LIVE_USER).update(
+        {"deleted_at": datetime.utcnow(), "is_active": False}, synchronize_session=False
+    )
+    if not deleted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
-    
-    # Деактивируем все refresh токены пользователя
-    from main import RefreshToken
-    db.query(RefreshToken).filter(RefreshToken.user_id == user_id).update(
-        {"is_active": False}
-    )
-    
-    db.delete(user)
+    release_identity(db, user_id)
+    record_event(db, "user.deleted", user_id)
     db.commit()
+    friend_cache.invalidate(user_id)
     
     return None
@@ -2,7 +2,6 @@
 """
 Скрипт для запуска сервера с правильными настройками CORS
 """
-import uvicorn
 import logging
 import sys
 import os
@@ -33,10 +32,15 @@ def main():
     os.makedirs("uploads/avatars", exist_ok=True)
     logger.info("📁 Папка uploads/avatars создана")
     
-    # Запускаем сервер
+    # В разработке создаем таблицы при старте (в продакшене - только явно)
+    os.environ.setdefault("CREATE_SCHEMA", "true")
+    
+    # Запускаем сервер (в разработке без задержки дренажа - перезапуск сразу)
+    from serve import serve
     try:
-        uvicorn.run(
+        serve(
             "main:app",
+            drain_delay=0,
             host="0.0.0.0",
             port=8000,
             reload=True,
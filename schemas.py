@@ -0,0 +1,91 @@
+from datetime import datetime, date
+from typing import List, Optional
+from pydantic import BaseModel, EmailStr
+
+# Pydantic models
+class UserCreate(BaseModel):
+    email: EmailStr
+    username: str
+    password: str
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+
+class UserProfileUpdate(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    phone: Optional[str] = None
+    birth_date: Optional[date] = None
+    bio: Optional[str] = None
+    location: Optional[str] = None
+    website: Optional[str] = None
+    company: Optional[str] = None
+    job_title: Optional[str] = None
+
+class UserPrivacySettings(BaseModel):
+    profile_visibility: Optional[str] = None
+    show_email: Optional[bool] = None
+    show_phone: Optional[bool] = None
+    show_birth_date: Optional[bool] = None
+
+class UserResponse(BaseModel):
+    id: int
+    email: str
+    username: str
+    is_active: bool
+    created_at: datetime
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    phone: Optional[str] = None
+    birth_date: Optional[date] = None
+    bio: Optional[str] = None
+    avatar_url: Optional[str] = None
+    location: Optional[str] = None
+    website: Optional[str] = None
+    company: Optional[str] = None
+    job_title: Optional[str] = None
+    profile_visibility: str
+    show_email: bool
+    show_phone: bool
+    show_birth_date: bool
+    last_login: Optional[datetime] = None
+    profile_updated_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class UserPublicProfile(BaseModel):
+    id: int
+    username: str
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    bio: Optional[str] = None
+    avatar_url: Optional[str] = None
+    location: Optional[str] = None
+    website: Optional[str] = None
+    company: Optional[str] = None
+    job_title: Optional[str] = None
+    created_at: datetime
+    
+    # Условно показываемые поля
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    birth_date: Optional[date] = None
+    
+    class Config:
+        from_attributes = True
+
+class UserUpdate(BaseModel):
+    email: Optional[EmailStr] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+class LoginRequest(BaseModel):
+    username: str
+    password: str
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+
+class IntrospectRequest(BaseModel):
+    tokens: List[str]
@@ -14,8 +14,13 @@ GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO fastapi_user;
 -- Create tables (these will be created automatically by SQLAlchemy, but here's the schema for reference)
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
-    email VARCHAR UNIQUE NOT NULL,
-    username VARCHAR UNIQUE NOT NULL,
+    email VARCHAR NOT NULL,
+    username VARCHAR NOT NULL,
+    -- crud.normalize_identity (strip().lower()): уникальность и поиск без учета регистра
+    email_normalized VARCHAR NOT NULL,
+    username_normalized VARCHAR NOT NULL,
+    -- мягкое удаление: NULL - аккаунт действует
+    deleted_at TIMESTAMP,
     hashed_password VARCHAR NOT NULL,
     is_active BOOLEAN DEFAULT TRUE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -31,7 +36,8 @@ CREATE TABLE IF NOT EXISTS refresh_tokens (
 );
 
 -- Create indexes for better performance
-CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
-CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email_live ON users(email_normalized) WHERE deleted_at IS NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username_live ON users(username_normalized) WHERE deleted_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_users_deleted_at ON users(deleted_at) WHERE deleted_at IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_refresh_tokens_token ON refresh_tokens(token);
 CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_id ON refresh_tokens(user_id);
@@ -0,0 +1,47 @@
+-- Поиск и уникальность email/username без учета регистра на живой таблице.
+-- Выполнять через psql без -1/--single-transaction: CREATE INDEX CONCURRENTLY
+-- не работает внутри транзакции, но не блокирует запись в users.
+
+-- 1. Колонки без значения по умолчанию добавляются мгновенно
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS email_normalized VARCHAR,
+ADD COLUMN IF NOT EXISTS username_normalized VARCHAR;
+
+-- 2. Заполнение пачками тем же crud.normalize_identity, что использует приложение
+--    (SQL lower(trim(...)) с ним не совпадает: trim убирает только пробелы,
+--    lower() в локали C не меняет кириллицу):
+--        python backfill_identity.py
+--    Повторить после выкладки кода (шаг 5): строки, записанные старой версией
+--    между заполнением и выкладкой, остаются с NULL
+
+-- 3. Дубликаты, различающиеся регистром, нужно разрешить вручную до построения индексов
+SELECT email_normalized, array_agg(id) FROM users GROUP BY email_normalized HAVING count(*) > 1;
+SELECT username_normalized, array_agg(id) FROM users GROUP BY username_normalized HAVING count(*) > 1;
+
+-- 4. Уникальные индексы без блокировки записи. Если построение прервалось,
+--    остается INVALID-индекс: DROP INDEX CONCURRENTLY и повторить шаг
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_users_email_normalized ON users(email_normalized);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_normalized ON users(username_normalized);
+
+-- 5. После выкладки кода, который заполняет колонки при записи, и повторного шага 2.
+--    SET NOT NULL напрямую сканирует всю таблицу под ACCESS EXCLUSIVE. Вместо этого
+--    CHECK NOT VALID (мгновенно), VALIDATE (сканирует, не блокируя запись),
+--    затем SET NOT NULL - PostgreSQL 12+ доказывает его по проверенному CHECK без сканирования
+SET lock_timeout = '5s';
+ALTER TABLE users ADD CONSTRAINT users_email_normalized_not_null CHECK (email_normalized IS NOT NULL) NOT VALID;
+ALTER TABLE users ADD CONSTRAINT users_username_normalized_not_null CHECK (username_normalized IS NOT NULL) NOT VALID;
+ALTER TABLE users VALIDATE CONSTRAINT users_email_normalized_not_null;
+ALTER TABLE users VALIDATE CONSTRAINT users_username_normalized_not_null;
+ALTER TABLE users ALTER COLUMN email_normalized SET NOT NULL;
+ALTER TABLE users ALTER COLUMN username_normalized SET NOT NULL;
+ALTER TABLE users DROP CONSTRAINT users_email_normalized_not_null;
+ALTER TABLE users DROP CONSTRAINT users_username_normalized_not_null;
+RESET lock_timeout;
+
+-- 6. Индексы по исходным колонкам больше не используются поиском - только замедляют запись
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_email;
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_username;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_email;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_username;
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_email_key;
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_username_key;
@@ -32,3 +32,109 @@ WHERE profile_updated_at IS NULL;
 -- Создание папки для загрузки аватаров (выполнить в системе)
 -- mkdir -p uploads/avatars
 -- chmod 755 uploads/avatars
+
+-- Предвычисленная заполненность профиля (число заполненных полей из 10)
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS profile_completeness INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users SET profile_completeness =
+    (COALESCE(first_name, '') <> '')::int +
+    (COALESCE(last_name, '') <> '')::int +
+    (COALESCE(phone, '') <> '')::int +
+    (birth_date IS NOT NULL)::int +
+    (COALESCE(bio, '') <> '')::int +
+    (COALESCE(location, '') <> '')::int +
+    (COALESCE(website, '') <> '')::int +
+    (COALESCE(company, '') <> '')::int +
+    (COALESCE(job_title, '') <> '')::int +
+    (COALESCE(avatar_url, '') <> '')::int;
+
+CREATE INDEX IF NOT EXISTS idx_users_profile_completeness ON users(profile_completeness);
+
+-- Материализованные агрегаты для дашбордов (пересчитываются приложением)
+CREATE TABLE IF NOT EXISTS profile_stats (
+    metric VARCHAR NOT NULL,
+    bucket VARCHAR NOT NULL,
+    value INTEGER NOT NULL,
+    refreshed_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (metric, bucket)
+);
+
+-- Сохраненные ответы для Idempotency-Key (IDEMPOTENCY_BACKEND=database)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(64) PRIMARY KEY,
+    fingerprint VARCHAR(64) NOT NULL,
+    status_code INTEGER,
+    headers TEXT,
+    body BYTEA,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Аренда выполняющегося запроса (для таблиц, созданных без этой колонки)
+ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
+
+-- Подписки: друзья - взаимные подписки; PK и обратный индекс покрывают оба направления
+CREATE TABLE IF NOT EXISTS follows (
+    follower_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    followee_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (follower_id, followee_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_follows_followee_follower ON follows(followee_id, follower_id);
+
+-- Мягкое удаление аккаунтов: строки удаляет фоновый purge.py пачками.
+-- Выполнять без -1/--single-transaction (CREATE INDEX CONCURRENTLY)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+-- Уникальность email/username только среди живых аккаунтов
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_live ON users(email_normalized) WHERE deleted_at IS NULL;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_live ON users(username_normalized) WHERE deleted_at IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_live_visibility ON users(profile_visibility, id) WHERE deleted_at IS NULL;
+-- Очередь на удаление: маленький индекс только по удаленным
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_deleted_at ON users(deleted_at) WHERE deleted_at IS NOT NULL;
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_email_normalized;
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_username_normalized;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_normalized;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_normalized;
+
+-- Версия профиля для ETag/If-Match (оптимистичная блокировка); DEFAULT без перезаписи таблицы (PG 11+)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- Transactional outbox событий пользователя (outbox.py): строки пишутся в транзакции изменения,
+-- фоновый диспетчер доставляет их пачками
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id SERIAL PRIMARY KEY,
+    event_type VARCHAR(64) NOT NULL,
+    aggregate_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    dispatched_at TIMESTAMP,
+    last_error TEXT
+);
+
+-- Очередь диспетчера: только недоставленные события
+CREATE INDEX IF NOT EXISTS ix_outbox_events_pending ON outbox_events(next_attempt_at, id) WHERE dispatched_at IS NULL;
+
+-- Шардирование пользователей (DATABASE_SHARD_URLS): каталог в общей БД выдает глобальные id
+-- и держит уникальность email/username по всем шардам. Таблицы users, refresh_tokens и
+-- outbox_events на шардах создаются и заполняются командой python reshard.py --to "..."
+CREATE TABLE IF NOT EXISTS user_directory (
+    id SERIAL PRIMARY KEY,
+    email_normalized VARCHAR UNIQUE,
+    username_normalized VARCHAR UNIQUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- follows остается в общей БД, а users уезжает на шарды: внешние ключи на users
+-- сняли бы при переносе (ON DELETE CASCADE) весь граф подписок, а новые id из каталога
+-- в общей users не появляются. reshard.py не запускается, пока ключи на месте
+ALTER TABLE follows DROP CONSTRAINT IF EXISTS follows_follower_id_fkey;
+ALTER TABLE follows DROP CONSTRAINT IF EXISTS follows_followee_id_fkey;
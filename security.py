@@ -0,0 +1,194 @@
+from fastapi import Depends, HTTPException, status, Cookie
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.orm import Session, undefer
+from passlib.context import CryptContext
+from jose import JWTError, jwt
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import time
+import uuid
+
+from config import (
+    SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS,
+    HASH_POOL_SIZE, HASH_POOL_MAX_QUEUE_PER_WORKER, TOKEN_CACHE_SIZE
+)
+from database import get_db
+from models import User, LIVE_USER, AUTH_COLUMNS
+from crud import get_user_by_id, get_user_by_username
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+security = HTTPBearer()
+
+# bcrypt - CPU-bound и отпускает GIL: выполняем в отдельном ограниченном пуле, а не в event loop
+hash_pool = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE, thread_name_prefix="bcrypt")
+_hash_pending = 0
+
+async def run_in_hash_pool(func, *args):
+    global _hash_pending
+    # Счетчик меняется только в потоке event loop - блокировка не нужна
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, func, *args)
+    finally:
+        _hash_pending -= 1
+
+def hash_pool_status() -> dict:
+    return {
+        "workers": HASH_POOL_SIZE,
+        "pending": _hash_pending,
+        "saturated": _hash_pending >= HASH_POOL_SIZE * HASH_POOL_MAX_QUEUE_PER_WORKER,
+    }
+
+# Utility functions
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_in_hash_pool(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await run_in_hash_pool(get_password_hash, password)
+
+def create_access_token(data: dict) -> str:
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire, "type": "access"})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def create_refresh_token(data: dict) -> str:
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    # jti делает токен уникальным: два входа в одну секунду иначе дают одинаковый токен
+    to_encode.update({"exp": expire, "type": "refresh", "jti": uuid.uuid4().hex})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def verify_token(token: str, token_type: str = "access") -> dict:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("type") != token_type:
+            raise JWTError("Invalid token type")
+        return payload
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials"
+        )
+
+class VerifiedTokenCache:
+    """LRU проверенных токенов: ключ - sha256 токена, запись живет до exp токена.
+
+    Подпись токена не меняется, поэтому повторная проверка до истечения не нужна;
+    удаление аккаунта проверяется отдельно - по строке пользователя.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    def get(self, digest: str) -> Optional[dict]:
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return entry[1]
+
+    def put(self, digest: str, payload: dict) -> None:
+        self._entries[digest] = (float(payload["exp"]), payload)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+token_cache = VerifiedTokenCache()
+
+def verify_tokens_cached(tokens: Iterable[str], token_type: str = "access") -> Dict[str, Optional[dict]]:
+    """Проверяет пачку токенов; результат - payload или None для каждого токена"""
+    results: Dict[str, Optional[dict]] = {}
+    for token in tokens:
+        if token in results:
+            continue
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        payload = token_cache.get(digest)
+        if payload is None:
+            try:
+                payload = verify_token(token, token_type)
+            except HTTPException:
+                results[token] = None
+                continue
+            if payload.get("sub") is None or payload.get("exp") is None:
+                results[token] = None
+                continue
+            token_cache.put(digest, payload)
+        results[token] = payload
+    return results
+
+async def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
+    user = get_user_by_username(db, username, *AUTH_COLUMNS)
+    if not user or not await verify_password_async(password, user.hashed_password):
+        return None
+    
+    # Обновляем время последнего входа
+    user.last_login = datetime.utcnow()
+    db.commit()
+    
+    return user
+
+def load_current_user(credentials: HTTPAuthorizationCredentials, db: Session, *options) -> User:
+    token = credentials.credentials
+    payload = verify_token(token, "access")
+    user_id = payload.get("sub")
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials"
+        )
+    
+    user = db.query(User).options(*options).filter(User.id == int(user_id), LIVE_USER).first()
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+    return user
+
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    return load_current_user(credentials, db)
+
+def get_current_user_profile(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    """Текущий пользователь вместе с отложенными колонками (bio) - для эндпоинтов профиля"""
+    return load_current_user(credentials, db, undefer(User.bio))
+
+def get_current_user_from_cookie(
+    access_token: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+) -> Optional[User]:
+    if not access_token:
+        return None
+    
+    try:
+        payload = verify_token(access_token, "access")
+        user_id = payload.get("sub")
+        if user_id:
+            return get_user_by_id(db, int(user_id))
+    except HTTPException:
+        return None
+    return None
+
+def warm_up_password_hashing() -> None:
+    """Загружает bcrypt-бэкенд passlib заранее, чтобы первый логин не платил за инициализацию"""
+    pwd_context.verify("warm-up", pwd_context.hash("warm-up"))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Запуск uvicorn с плавной остановкой (дренаж перед выходом, см. lifecycle.py)"""
+import asyncio
+import argparse
+from typing import Optional
+
+import uvicorn
+from uvicorn.supervisors import ChangeReload, Multiprocess
+
+from config import SHUTDOWN_DRAIN_DELAY, SHUTDOWN_TIMEOUT
+from lifecycle import is_draining, set_draining
+
+
+class DrainingServer(uvicorn.Server):
+    """По первому сигналу воркер только переходит в дренаж (readiness 503, запросы
+    обслуживаются) и останавливается через drain_delay секунд; повторный сигнал - сразу."""
+
+    drain_delay: float = SHUTDOWN_DRAIN_DELAY
+
+    def handle_exit(self, sig, frame) -> None:
+        if self.should_exit or is_draining() or self.drain_delay <= 0:
+            super().handle_exit(sig, frame)
+            return
+        set_draining(True)
+        print(f"Получен сигнал {sig}: дренаж, остановка через {self.drain_delay} с")
+        asyncio.get_event_loop().call_later(self.drain_delay, super().handle_exit, sig, frame)
+
+
+def serve(app: str = "main:app", drain_delay: Optional[float] = None, **kwargs) -> None:
+    """Аналог uvicorn.run с DrainingServer; kwargs передаются в uvicorn.Config"""
+    kwargs.setdefault("timeout_graceful_shutdown", int(SHUTDOWN_TIMEOUT))
+    config = uvicorn.Config(app, **kwargs)
+    server = DrainingServer(config=config)
+    if drain_delay is not None:
+        server.drain_delay = drain_delay
+    
+    if config.should_reload:
+        ChangeReload(config, target=server.run, sockets=[config.bind_socket()]).run()
+    elif config.workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Запуск API с плавной остановкой")
+    parser.add_argument("app", nargs="?", default="main:app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--drain-delay", type=float, default=None)
+    args = parser.parse_args()
+    
+    serve(args.app, drain_delay=args.drain_delay, host=args.host, port=args.port, workers=args.workers)
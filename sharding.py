@@ -0,0 +1,167 @@
+"""Маршрутизация сессии по шардам пользователей (ShardedSession из SQLAlchemy).
+
+Таблицы database.SHARD_KEYS лежат на шардах, строка - на шарде id своего
+пользователя; остальные таблицы - в общей БД (GLOBAL_SHARD). Шард запроса
+определяется по условиям WHERE верхнего уровня: id пользователя (= или IN)
+или нормализованный email/username (через каталог user_directory). Запрос
+без таких условий выполняется на всех шардах, результаты объединяются -
+страницы со слиянием по id собирает crud.fetch_user_page.
+"""
+from sqlalchemy import event, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import ORMExecuteState
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.expression import Exists, Select, TableClause
+from typing import Iterable, List, Optional, Set
+
+from database import SHARD_KEYS, GLOBAL_SHARD, SessionLocal, get_engine, shards
+from models import UserDirectory
+
+# Колонки с id пользователя, определяющие шард строки
+SHARD_KEY_COLUMNS = frozenset(SHARD_KEYS.items())
+# Нормализованные email/username: шард находится через каталог
+DIRECTORY_COLUMNS = {
+    ("users", "email_normalized"): UserDirectory.email_normalized,
+    ("users", "username_normalized"): UserDirectory.username_normalized,
+}
+
+
+def _table_names(statement) -> Set[str]:
+    return {element.name for element in visitors.iterate(statement) if isinstance(element, TableClause)}
+
+def _conjuncts(clause) -> List:
+    """Условия, соединенные AND на верхнем уровне (условия внутри OR шард не сужают)"""
+    if clause is None:
+        return []
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        return [part for item in clause.clauses for part in _conjuncts(item)]
+    return [clause]
+
+def _inner_select(element) -> Optional[Select]:
+    for child in visitors.iterate(element):
+        if isinstance(child, Select):
+            return child
+    return None
+
+def _bound_ids(parameter) -> Optional[Set[int]]:
+    if not isinstance(parameter, BindParameter):
+        return None
+    value = parameter.effective_value
+    values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+    try:
+        return {int(item) for item in values}
+    except (TypeError, ValueError):
+        return None
+
+def _lookup_directory(session, column, parameter) -> Optional[Set[int]]:
+    if not isinstance(parameter, BindParameter):
+        return None
+    # Каталог читается в транзакции сессии - видны и незакоммиченные резервы этого запроса
+    connection = session.connection(bind_arguments={"shard_id": GLOBAL_SHARD})
+    return set(connection.execute(select(UserDirectory.id).where(column == parameter.effective_value)).scalars())
+
+def _user_ids(statement, session) -> Optional[Set[int]]:
+    """id пользователей, которыми ограничен запрос; None - ограничения нет"""
+    clauses = _conjuncts(getattr(statement, "whereclause", None))
+    # select(exists().where(...)) - так выглядит crud.user_exists
+    for column in getattr(statement, "selected_columns", ()):
+        if isinstance(column, Exists):
+            inner = _inner_select(column)
+            if inner is not None:
+                clauses += _conjuncts(inner.whereclause)
+
+    user_ids: Optional[Set[int]] = None
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or clause.operator not in (operators.eq, operators.in_op):
+            continue
+        table = getattr(clause.left, "table", None)
+        key = (getattr(table, "name", None), getattr(clause.left, "name", None))
+        ids = None
+        if key in SHARD_KEY_COLUMNS:
+            ids = _bound_ids(clause.right)
+            if ids is None:
+                # IN (подзапрос) - строки подзапроса лежат на тех же шардах
+                inner = _inner_select(clause.right)
+                if inner is not None:
+                    ids = _user_ids(inner, session)
+        elif key in DIRECTORY_COLUMNS and clause.operator is operators.eq:
+            ids = _lookup_directory(session, DIRECTORY_COLUMNS[key], clause.right)
+        if ids is not None:
+            user_ids = ids if user_ids is None else user_ids & ids
+    return user_ids
+
+def shards_for_users(user_ids: Iterable[int]) -> List[str]:
+    return sorted({shards.shard_for(user_id) for user_id in user_ids})
+
+def execute_chooser(context: ORMExecuteState) -> List[str]:
+    statement = context.statement
+    tables = _table_names(statement)
+    sharded = tables & SHARD_KEYS.keys()
+    if not sharded:
+        return [GLOBAL_SHARD]
+    if tables - sharded - {UserDirectory.__tablename__}:
+        raise RuntimeError(f"Запрос соединяет таблицы шардов и общей БД: {sorted(tables)}")
+
+    if context.is_insert:
+        table = statement.table.name
+        user_id = statement.compile().params.get(SHARD_KEYS[table])
+        if user_id is None:
+            raise RuntimeError(f"INSERT в {table} без {SHARD_KEYS[table]} - шард не определить")
+        return [shards.shard_for(int(user_id))]
+
+    user_ids = _user_ids(statement, context.session)
+    if user_ids is None:
+        return shards.names
+    # Пользователя нет в каталоге - запрос на любом шарде вернет пустой результат
+    return shards_for_users(user_ids) or shards.names[:1]
+
+def shard_chooser(mapper, instance, clause=None, **kw) -> str:
+    table = mapper.local_table.name
+    if table not in SHARD_KEYS:
+        return GLOBAL_SHARD
+    if instance is None:
+        # get_bind(User) - нужен только диалект, он одинаков на всех шардах
+        return shards.names[0]
+    user_id = getattr(instance, SHARD_KEYS[table])
+    if user_id is None:
+        raise RuntimeError(f"{mapper.class_.__name__} без {SHARD_KEYS[table]} - шард не определить")
+    return shards.shard_for(user_id)
+
+def identity_chooser(mapper, primary_key, **kw) -> List[str]:
+    table = mapper.local_table.name
+    if table == "users":
+        return [shards.shard_for(primary_key[0])]
+    return shards.names if table in SHARD_KEYS else [GLOBAL_SHARD]
+
+
+def _pin_single_shard(context: ORMExecuteState) -> None:
+    """Запрос одного шарда выполняется напрямую: ShardedSession иначе объединяет
+    результаты в MergedResult, у которого нет rowcount"""
+    if "shard_id" in context.bind_arguments:
+        return
+    shard_ids = context.session.execute_chooser(context)
+    if len(shard_ids) == 1:
+        context.bind_arguments["shard_id"] = shard_ids[0]
+
+
+class RoutingSession(ShardedSession):
+    """ShardedSession, у которой get_bind() без аргументов - общая БД (как у обычной сессии)"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        event.listen(self, "do_orm_execute", _pin_single_shard, insert=True)
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        if shard_id is None and mapper is None and instance is None:
+            shard_id = GLOBAL_SHARD
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+def create_sharded_session() -> RoutingSession:
+    return RoutingSession(
+        shard_chooser=shard_chooser,
+        identity_chooser=identity_chooser,
+        execute_chooser=execute_chooser,
+        shards={GLOBAL_SHARD: get_engine(), **shards.engines()},
+        **SessionLocal.kw
+    )